@@ -1,20 +1,187 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context, g, \
+    has_request_context, abort, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
+from sqlalchemy import func, and_, or_, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import joinedload, aliased, make_transient_to_detached, deferred, validates
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.types import TypeDecorator
+from markupsafe import Markup
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
+import base64
+import csv
+import hashlib
+import io
 import json
 import os
+import re
+import socket
+import sqlite3
+import threading
+import weakref
+import zlib
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# Defaults every app starts from. Deployment-specific values come from the
+# environment (see config_from_env), and any key can be overridden with an
+# HMS_-prefixed variable, e.g. HMS_DB_POOL_SIZE=5.
+DEFAULT_CONFIG = {
+    'SECRET_KEY': 'change_this_secret',
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///hospital.db',
+    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+    'ADMIN_PAGE_SIZE': 50,
+    'ADMIN_DOCTOR_LIST': 20,  # newest doctors on the dashboard; the rest via doctor search
+    'API_PAGE_SIZE': 100,
+    'API_MAX_PAGE_SIZE': 1000,
+    'API_STREAM_BATCH': 1000,
+    'SEARCH_PAGE_SIZE': 20,
+    'TYPEAHEAD_LIMIT': 10,
+    'BULK_BATCH_SIZE': 1000,
+    'DOCTOR_DASHBOARD_DAYS': 7,
+    'SCHEDULE_MAX_DAYS': 92,
+    'EXPORT_BATCH': 2000,  # rows fetched per round trip while exporting
+    'ARCHIVE_HORIZON_DAYS': 365,  # finished appointments older than this move to the archive
+    'ARCHIVE_BATCH_SIZE': 500,  # appointments moved per transaction
+    'SLOT_HOLD_TTL': 120,  # seconds a patient may hold a slot while booking it
+    'SLOT_HOLD_SWEEP_INTERVAL': 60,  # seconds between expired-hold sweeps, per process
+    'PROFILE_CACHE_SIZE': 4096,
+    'PROFILE_CACHE_TTL': 300,  # seconds; also bounds how stale another worker's copy can be
+    'DIRECTORY_RECHECK_SECONDS': 2,  # how often a worker checks the shared directory version
+    # recurring availability
+    'AVAILABILITY_HORIZON_DAYS': 90,  # days of rule expansion materialized into availability_slot
+    'BOOKING_WINDOW_DAYS': 7,  # days shown for booking on a doctor's profile
+    'SCHEDULE_CACHE_SIZE': 1024,  # compiled doctor schedules kept per process
+    'SCHEDULE_CACHE_TTL': 600,
+    'SCHEDULE_RECHECK_SECONDS': 2,  # how often a cached schedule's version is checked
+    'PAGE_CACHE_SIZE': 2048,  # rendered pages kept per process, keyed by ETag
+    'PAGE_CACHE_TTL': 300,  # seconds
+    # background jobs (flask run-worker)
+    'JOB_WORKER_THREADS': 4,
+    'JOB_POLL_INTERVAL': 1.0,  # seconds between polls of an empty queue
+    'JOB_CLAIM_BATCH': 50,  # jobs claimed per round trip
+    'JOB_MAX_ATTEMPTS': 5,
+    'JOB_BACKOFF_BASE': 5,  # seconds before the first retry; doubles per attempt
+    'JOB_BACKOFF_MAX': 600,
+    'JOB_TIMEOUT': 900,  # running jobs older than this are assumed lost and requeued
+    'JOB_PERIODIC_CHECK': 60,  # seconds between a worker's checks for due PERIODIC_JOBS
+    'REMINDER_LEAD_DAYS': 1,  # reminders go out this many days ahead
+    'EXPORT_DIR': None,  # where background exports are written; default <instance>/exports
+    # SQLite connection tuning; WAL lets readers run alongside the single writer
+    'SQLITE_WAL': True,
+    'SQLITE_BUSY_TIMEOUT_MS': 5000,
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'DB_POOL_SIZE': 10,  # per worker process
+    'DB_MAX_OVERFLOW': 20,
+    'DB_POOL_TIMEOUT': 30,
+    # opt-in per-request SQL profiling; nothing is hooked up when disabled
+    'SQL_PROFILING': False,
+    'PROFILING_WINDOW': 500,  # rolling samples kept per endpoint
+    'PROFILING_SLOW_STATEMENTS': 5,
+    'N_PLUS_ONE_THRESHOLD': 5,  # same statement, different params, this many times
+    'SLOW_REQUEST_MS': 500,
+    'METRICS_TOKEN': None,  # optional bearer token for /metrics
+    # password hashing; stored hashes using other parameters are upgraded on the next login
+    'PASSWORD_HASH_METHOD': 'scrypt:32768:8:1',
+    'PASSWORD_SALT_LENGTH': 16,
+    'PASSWORD_VERIFY_WORKERS': os.cpu_count() or 2,  # per worker process
+    'PASSWORD_VERIFY_MAX_PENDING': None,  # default: 4 * PASSWORD_VERIFY_WORKERS
+    'PASSWORD_VERIFY_WAIT': 10,  # seconds to wait for a free verification slot
+    # login throttling: token buckets per username and per client address (per worker process)
+    'LOGIN_USER_BURST': 10,
+    'LOGIN_USER_REFILL_PER_SEC': 1 / 6,
+    'LOGIN_IP_BURST': 100,
+    'LOGIN_IP_REFILL_PER_SEC': 5,
+}
+
+
+def database_url(url):
+    # hosted Postgres often hands out postgres://, which SQLAlchemy no longer accepts; a
+    # bare scheme would pick psycopg2, so point both at psycopg 3 (requirements-postgres.txt)
+    for scheme in ('postgres://', 'postgresql://'):
+        if url.startswith(scheme):
+            return 'postgresql+psycopg://' + url[len(scheme):]
+    return url
+
+
+def config_from_env(environ=os.environ):
+    """Settings taken from well-known environment variables, when set."""
+    config = {}
+    if environ.get('SECRET_KEY'):
+        config['SECRET_KEY'] = environ['SECRET_KEY']
+    if environ.get('DATABASE_URL'):
+        # e.g. sqlite:////var/lib/hms/hospital.db or postgresql://hms@localhost/hms (needs requirements-postgres.txt)
+        config['SQLALCHEMY_DATABASE_URI'] = database_url(environ['DATABASE_URL'])
+    if 'SQL_PROFILING' in environ:
+        config['SQL_PROFILING'] = environ['SQL_PROFILING'] in ('1', 'true', 'yes')
+    for key in ('METRICS_TOKEN', 'PASSWORD_HASH_METHOD'):
+        if environ.get(key):
+            config[key] = environ[key]
+    return config
+
+
+def engine_options(config):
+    """Pool settings for file/server databases; in-memory SQLite keeps its static pool."""
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+    return {'pool_size': config['DB_POOL_SIZE'], 'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_timeout': config['DB_POOL_TIMEOUT'], 'pool_pre_ping': url.get_backend_name() != 'sqlite'}
+
+
+db = SQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+bp = Blueprint('main', __name__, cli_group=None)
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'change_this_secret'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hospital.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
+# -------------------------
+# Column types
+# -------------------------
+class CompressedText(TypeDecorator):
+    """Text stored zlib-compressed (base64, 'zlib:' prefix) once compression pays off.
+
+    Short values, and rows written before this type existed, are stored and read
+    as plain text, so the column needs no migration.
+    """
+    impl = db.Text
+    cache_ok = True
+    PREFIX = 'zlib:'
+    MIN_BYTES = 256
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        raw = value.encode('utf-8')
+        # values that look compressed are always encoded so reads stay unambiguous
+        if len(raw) < self.MIN_BYTES and not value.startswith(self.PREFIX):
+            return value
+        packed = self.PREFIX + base64.b64encode(zlib.compress(raw, 6)).decode('ascii')
+        return packed if len(packed) < len(value) or value.startswith(self.PREFIX) else value
+
+    def process_result_value(self, value, dialect):
+        if value is None or not value.startswith(self.PREFIX):
+            return value
+        return zlib.decompress(base64.b64decode(value[len(self.PREFIX):])).decode('utf-8')
+
+
+TREATMENT_PREVIEW_CHARS = 120
+
+
+def text_preview(value):
+    """First line of ``value`` cut to TREATMENT_PREVIEW_CHARS, with an ellipsis if anything was dropped."""
+    if not value:
+        return value
+    first = value.strip().split('\n', 1)[0]
+    if len(first) > TREATMENT_PREVIEW_CHARS:
+        return first[:TREATMENT_PREVIEW_CHARS - 1].rstrip() + '…'
+    return first if first == value.strip() else first + ' …'
 
 
 # -------------------------
@@ -30,10 +197,18 @@ class User(UserMixin, db.Model):
     active = db.Column(db.Boolean, default=True)
 
     def set_password(self, pw):
-        self.password_hash = generate_password_hash(pw)
+        self.password_hash = generate_password_hash(pw, method=current_app.config['PASSWORD_HASH_METHOD'],
+                                                    salt_length=current_app.config['PASSWORD_SALT_LENGTH'])
 
     def check_password(self, pw):
-        return check_password_hash(self.password_hash, pw)
+        return password_verifier.verify(self.password_hash, pw)
+
+    def password_needs_rehash(self):
+        """True when the stored hash's method or salt length differs from the configured ones."""
+        parts = self.password_hash.split('$')
+        if parts[0] != hash_method_prefix(current_app.config['PASSWORD_HASH_METHOD']):
+            return True
+        return len(parts) < 3 or len(parts[1]) != current_app.config['PASSWORD_SALT_LENGTH']
 
 
 class Department(db.Model):
@@ -45,9 +220,9 @@ class Department(db.Model):
 
 class Doctor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     specialization = db.Column(db.String(120))
-    availability_json = db.Column(db.Text)  # {"YYYY-MM-DD": ["09:00","10:00"]}
+    availability_json = db.Column(db.Text)  # legacy {"YYYY-MM-DD": ["09:00"]}, migrated to AvailabilitySlot
     department_id = db.Column(db.Integer, db.ForeignKey('department.id'), nullable=True)
 
     user = db.relationship('User')
@@ -55,7 +230,7 @@ class Doctor(db.Model):
 
 class Patient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     age = db.Column(db.Integer)
     medical_info = db.Column(db.Text)
 
@@ -74,28 +249,922 @@ class Appointment(db.Model):
     patient = db.relationship('Patient')
     doctor = db.relationship('Doctor')
 
+    # uix_doctor_datetime also serves (doctor_id, date) lookups such as the doctor's
+    # upcoming appointments, so it doubles as that composite index.
     __table_args__ = (
         db.UniqueConstraint('doctor_id', 'date', 'time', name='uix_doctor_datetime'),
+        db.Index('ix_appointment_patient_date', 'patient_id', 'date'),
+        db.Index('ix_appointment_date_id', 'date', 'id'),
+        db.Index('ix_appointment_status', 'status'),
     )
 
 
 class Treatment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False)
-    diagnosis = db.Column(db.Text)
-    prescription = db.Column(db.Text)
-    notes = db.Column(db.Text)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=False, index=True)
+    # full texts load only when accessed (all three together); list views use the previews
+    diagnosis = deferred(db.Column(CompressedText), group='text')
+    prescription = deferred(db.Column(CompressedText), group='text')
+    notes = deferred(db.Column(CompressedText), group='text')
+    diagnosis_preview = db.Column(db.String(TREATMENT_PREVIEW_CHARS + 2))
+    prescription_preview = db.Column(db.String(TREATMENT_PREVIEW_CHARS + 2))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     appointment = db.relationship('Appointment', backref=db.backref('treatments', cascade='all, delete-orphan'))
 
+    @validates('diagnosis', 'prescription')
+    def _set_preview(self, key, value):
+        setattr(self, f'{key}_preview', text_preview(value))
+        return value
+
+
+class AppointmentArchive(db.Model):
+    """Completed/cancelled appointments moved out of ``appointment`` (same ids and columns)."""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20))
+    archived_at = db.Column(db.DateTime)
+
+    patient = db.relationship('Patient')
+    doctor = db.relationship('Doctor')
+    treatments = db.relationship('TreatmentArchive', order_by='TreatmentArchive.id', backref='appointment')
+
+    __table_args__ = (
+        db.Index('ix_appointment_archive_patient_date', 'patient_id', 'date'),
+    )
+
+
+class TreatmentArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment_archive.id'), nullable=False, index=True)
+    diagnosis = deferred(db.Column(CompressedText), group='text')
+    prescription = deferred(db.Column(CompressedText), group='text')
+    notes = deferred(db.Column(CompressedText), group='text')
+    diagnosis_preview = db.Column(db.String(TREATMENT_PREVIEW_CHARS + 2))
+    prescription_preview = db.Column(db.String(TREATMENT_PREVIEW_CHARS + 2))
+    created_at = db.Column(db.DateTime)
+
+
+class AvailabilitySlot(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time = db.Column(db.String(20), nullable=False)  # same format as Appointment.time
+
+    __table_args__ = (
+        db.UniqueConstraint('doctor_id', 'date', 'time', name='uix_slot_doctor_datetime'),
+        db.Index('ix_slot_date_time', 'date', 'time'),
+    )
+
+
+class AvailabilityRule(db.Model):
+    """Weekly recurring availability: ``slot_minutes`` slots from ``start_time`` to ``end_time``."""
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False, index=True)
+    weekday = db.Column(db.Integer, nullable=False)  # 0 = Monday, as date.weekday()
+    start_time = db.Column(db.String(5), nullable=False)  # HH:MM
+    end_time = db.Column(db.String(5), nullable=False)  # HH:MM, exclusive
+    slot_minutes = db.Column(db.Integer, nullable=False, default=30)
+    valid_from = db.Column(db.Date)  # open-ended when NULL
+    valid_until = db.Column(db.Date)
+
+
+class AvailabilityException(db.Model):
+    """A date-specific change to a doctor's rules.
+
+    ``add`` offers an extra slot at ``time``; ``remove`` drops the slot at
+    ``time``, or the whole day when ``time`` is NULL.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time = db.Column(db.String(20))
+    kind = db.Column(db.String(10), nullable=False)  # add / remove
+
+    __table_args__ = (
+        db.Index('ix_availability_exception_doctor_date', 'doctor_id', 'date'),
+    )
+
+
+class SlotHold(db.Model):
+    """Short-lived reservation of a slot by the patient who is booking it."""
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time = db.Column(db.String(20), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('doctor_id', 'date', 'time', name='uix_hold_doctor_datetime'),
+        db.Index('ix_slot_hold_expires_at', 'expires_at'),
+    )
+
+
+class DoctorOccupancy(db.Model):
+    """Per-doctor, per-day appointment counters, maintained on every write."""
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    slots = db.Column(db.Integer, nullable=False, default=0)  # availability slots offered that day
+    booked = db.Column(db.Integer, nullable=False, default=0)
+    completed = db.Column(db.Integer, nullable=False, default=0)
+    cancelled = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('doctor_id', 'date', name='uix_occupancy_doctor_date'),
+    )
+
+    @property
+    def free(self):
+        # every appointment row holds its uix_doctor_datetime key, cancelled ones included
+        return max((self.slots or 0) - (self.booked or 0) - (self.completed or 0) - (self.cancelled or 0), 0)
+
+
+class AppointmentRollup(db.Model):
+    """Appointment counts per (day, doctor, department, status) for reporting."""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    doctor_id = db.Column(db.Integer, nullable=False)
+    department_id = db.Column(db.Integer, nullable=False, default=0)  # 0 = no department
+    status = db.Column(db.String(20), nullable=False)
+    appointments = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'doctor_id', 'department_id', 'status', name='uix_appt_rollup_key'),
+    )
+
+
+class TreatmentRollup(db.Model):
+    """Treatments recorded per (day, doctor, department) for reporting."""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    doctor_id = db.Column(db.Integer, nullable=False)
+    department_id = db.Column(db.Integer, nullable=False, default=0)
+    treatments = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('day', 'doctor_id', 'department_id', name='uix_treatment_rollup_key'),
+    )
+
+
+class Job(db.Model):
+    """A unit of deferred work, claimed and run by ``flask run-worker``."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)
+    payload = db.Column(db.Text)  # JSON
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued / running / done / failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_after = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    worker = db.Column(db.String(80))
+    last_error = db.Column(db.Text)
+    result = db.Column(db.Text)  # JSON
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_after', 'status', 'run_after'),
+    )
+
+
+class Notification(db.Model):
+    """Outgoing message to a user (reminders, cancellations); delivery channels read from here."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    appointment_id = db.Column(db.Integer)
+    kind = db.Column(db.String(40), nullable=False)
+    message = db.Column(db.String(500), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('appointment_id', 'kind', name='uix_notification_appointment_kind'),
+    )
+
+
+class EntityVersion(db.Model):
+    """Change counter per entity, e.g. ('patient', 12), shared by every worker process.
+
+    Bumped in the same transaction as the change, so anything derived from a
+    version (an ETag, a cached page) stays valid exactly until the next write.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)  # 'patient', 'doctor', 'doctor_directory'
+    entity_id = db.Column(db.Integer, nullable=False, default=0)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'entity_id', name='uix_entity_version'),
+    )
+
+
+class ExportWatermark(db.Model):
+    """Highest appointment/treatment ids already delivered by a named incremental export."""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    last_appointment_id = db.Column(db.Integer, nullable=False, default=0)
+    last_treatment_id = db.Column(db.Integer, nullable=False, default=0)
+    rows = db.Column(db.Integer, nullable=False, default=0)  # rows in the last run
+    exported_at = db.Column(db.DateTime)
+
+
+# -------------------------
+# Engine setup
+# -------------------------
+def configure_sqlite_connection(dbapi_conn, config):
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    cursor = dbapi_conn.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    if config['SQLITE_WAL']:
+        cursor.execute('PRAGMA journal_mode = WAL')
+    if config['SQLITE_SYNCHRONOUS'] in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        cursor.execute(f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']}")
+    cursor.close()
+
+
+def init_engines(app):
+    """Per-engine setup: SQLite PRAGMAs on every new connection, and fresh pools after a fork.
+
+    Pre-forking servers (gunicorn --preload, uWSGI) may fork after create_app; a
+    child must never reuse connections its parent opened, so each child drops the
+    inherited pool (without closing the parent's sockets) and connects on demand.
+    """
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        listener = getattr(engine, '_hms_connect_listener', None)
+        if engine.dialect.name == 'sqlite' and not (listener and event.contains(engine, 'connect', listener)):
+            def listener(conn, record, config=app.config):
+                configure_sqlite_connection(conn, config)
+            engine._hms_connect_listener = listener
+            event.listen(engine, 'connect', listener)
+        _forked_engines.add(engine)
+
+
+# One fork hook for the process. Engines are held weakly, so apps built and
+# dropped by tests and tools don't keep their engines alive through it.
+_forked_engines = weakref.WeakSet()
+
+
+def _dispose_engines_after_fork():
+    for engine in list(_forked_engines):
+        engine.dispose(close=False)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+
+# derived tables to populate from existing data when an upgrade creates them
+TABLE_BACKFILLS = {
+    'doctor_occupancy': lambda: rebuild_occupancy(),
+    'appointment_rollup': lambda: rebuild_rollups(),
+    'treatment_rollup': lambda: rebuild_rollups(),
+}
+
+
+# columns to populate from existing data when an upgrade adds them
+COLUMN_BACKFILLS = {
+    ('treatment', 'diagnosis_preview'): lambda: compact_treatment_text(Treatment),
+    ('treatment_archive', 'diagnosis_preview'): lambda: compact_treatment_text(TreatmentArchive),
+}
+
+
+def upgrade_schema():
+    """Bring an existing database up to the current models; safe to re-run.
+
+    Creates missing tables, columns and indexes and, on SQLite, switches the
+    file to WAL and refreshes planner statistics. Returns a list of actions taken.
+    """
+    actions = []
+    inspector = db.inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            actions.append(f'created table {table.name}')
+            if table.name in TABLE_BACKFILLS:
+                TABLE_BACKFILLS[table.name]()
+                actions.append(f'backfilled {table.name}')
+            continue
+        existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                # only nullable, default-free columns are added this way
+                ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                with db.engine.begin() as conn:
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {ddl}')
+                actions.append(f'added column {table.name}.{column.name}')
+        # backfill once the table has all of its columns
+        for column in table.columns:
+            if column.name not in existing_columns and (table.name, column.name) in COLUMN_BACKFILLS:
+                COLUMN_BACKFILLS[(table.name, column.name)]()
+                actions.append(f'backfilled {table.name}.{column.name}')
+        existing_indexes = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=db.engine, checkfirst=True)
+                actions.append(f'created index {index.name}')
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.begin() as conn:
+            if current_app.config['SQLITE_WAL']:
+                mode = conn.exec_driver_sql('PRAGMA journal_mode = WAL').scalar()
+                actions.append(f'journal_mode={mode}')
+            conn.exec_driver_sql('ANALYZE')
+            actions.append('analyzed')
+    return actions
+
+
+# -------------------------
+# Search index (SQLite FTS5)
+# -------------------------
+# One FTS row per doctor (rowid = 2*id) and per patient (rowid = 2*id + 1),
+# denormalized from user/doctor/department. Triggers keep it in sync with every
+# insert, update (including toggling ``active``) and delete, whatever the write path.
+SEARCH_DOCTOR_ROWS = (
+    "SELECT d.id * 2, 'doctor', d.id, u.active, u.full_name, u.username, u.contact, d.specialization, dep.name "
+    "FROM doctor d JOIN \"user\" u ON u.id = d.user_id LEFT JOIN department dep ON dep.id = d.department_id"
+)
+SEARCH_PATIENT_ROWS = (
+    "SELECT p.id * 2 + 1, 'patient', p.id, u.active, u.full_name, u.username, u.contact, NULL, NULL "
+    "FROM patient p JOIN \"user\" u ON u.id = p.user_id"
+)
+SEARCH_INSERT = ('INSERT INTO search_fts (rowid, kind, entity_id, active, full_name, username, contact, '
+                 'specialization, department) ')
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5("
+    "kind UNINDEXED, entity_id UNINDEXED, active UNINDEXED, full_name, username, contact, specialization, "
+    "department, tokenize='unicode61', prefix='2 3')",
+    f"CREATE TRIGGER IF NOT EXISTS search_doctor_ai AFTER INSERT ON doctor BEGIN "
+    f"{SEARCH_INSERT}{SEARCH_DOCTOR_ROWS} WHERE d.id = new.id; END",
+    f"CREATE TRIGGER IF NOT EXISTS search_doctor_au AFTER UPDATE ON doctor BEGIN "
+    f"DELETE FROM search_fts WHERE rowid = old.id * 2; {SEARCH_INSERT}{SEARCH_DOCTOR_ROWS} WHERE d.id = new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS search_doctor_ad AFTER DELETE ON doctor BEGIN "
+    "DELETE FROM search_fts WHERE rowid = old.id * 2; END",
+    f"CREATE TRIGGER IF NOT EXISTS search_patient_ai AFTER INSERT ON patient BEGIN "
+    f"{SEARCH_INSERT}{SEARCH_PATIENT_ROWS} WHERE p.id = new.id; END",
+    f"CREATE TRIGGER IF NOT EXISTS search_patient_au AFTER UPDATE ON patient BEGIN "
+    f"DELETE FROM search_fts WHERE rowid = old.id * 2 + 1; {SEARCH_INSERT}{SEARCH_PATIENT_ROWS} WHERE p.id = new.id; END",
+    "CREATE TRIGGER IF NOT EXISTS search_patient_ad AFTER DELETE ON patient BEGIN "
+    "DELETE FROM search_fts WHERE rowid = old.id * 2 + 1; END",
+    f"CREATE TRIGGER IF NOT EXISTS search_user_au AFTER UPDATE ON \"user\" BEGIN "
+    f"DELETE FROM search_fts WHERE rowid IN (SELECT id * 2 FROM doctor WHERE user_id = new.id "
+    f"UNION ALL SELECT id * 2 + 1 FROM patient WHERE user_id = new.id); "
+    f"{SEARCH_INSERT}{SEARCH_DOCTOR_ROWS} WHERE d.user_id = new.id; "
+    f"{SEARCH_INSERT}{SEARCH_PATIENT_ROWS} WHERE p.user_id = new.id; END",
+    f"CREATE TRIGGER IF NOT EXISTS search_department_au AFTER UPDATE OF name ON department BEGIN "
+    f"DELETE FROM search_fts WHERE rowid IN (SELECT id * 2 FROM doctor WHERE department_id = new.id); "
+    f"{SEARCH_INSERT}{SEARCH_DOCTOR_ROWS} WHERE d.department_id = new.id; END",
+]
+# bm25 weights, in column order: kind, entity_id, active, full_name, username, contact, specialization, department
+SEARCH_RANK = 'bm25(search_fts, 0, 0, 0, 10.0, 5.0, 2.0, 3.0, 3.0)'
+
+
+def rebuild_search_index(connection=None):
+    """Repopulate the FTS table from the base tables."""
+    conn = connection or db.session
+    conn.execute(db.text('DELETE FROM search_fts'))
+    conn.execute(db.text(SEARCH_INSERT + SEARCH_DOCTOR_ROWS))
+    conn.execute(db.text(SEARCH_INSERT + SEARCH_PATIENT_ROWS))
+
+
+@event.listens_for(db.metadata, 'after_create')
+def create_search_index(target, connection, **kw):
+    if connection.dialect.name != 'sqlite':
+        return
+    existed = connection.execute(db.text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_fts'")).first()
+    for ddl in SEARCH_INDEX_DDL:
+        connection.execute(db.text(ddl))
+    if not existed:
+        rebuild_search_index(connection)
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(db.text('DROP TABLE IF EXISTS search_fts'))
+
+
+# -------------------------
+# Caching
+# -------------------------
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl`` seconds."""
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return self.MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl, 'hits': self.hits,
+                    'misses': self.misses, 'hit_ratio': round(self.hits / total, 4) if total else None}
+
+
+# Column snapshots of users and their doctor/patient rows, keyed by (kind, user_id).
+# Snapshots rather than ORM instances are cached so nothing is shared between sessions.
+profile_cache = TTLCache(DEFAULT_CONFIG['PROFILE_CACHE_SIZE'], DEFAULT_CONFIG['PROFILE_CACHE_TTL'])  # sized by create_app
+
+
+def cached_row(kind, user_id, model, loader):
+    """Return ``loader()``'s row for this user, served from ``profile_cache`` when possible."""
+    key = (kind, user_id)
+    cols = profile_cache.get(key)
+    if cols is TTLCache.MISSING:
+        obj = loader()
+        profile_cache.set(key, {a.key: getattr(obj, a.key) for a in obj.__mapper__.column_attrs} if obj else None)
+        return obj
+    if cols is None:
+        return None
+    obj = model(**cols)
+    make_transient_to_detached(obj)
+    return db.session.merge(obj, load=False)
+
+
+def invalidate_user_cache(user_id):
+    profile_cache.invalidate(('user', user_id), ('doctor', user_id), ('patient', user_id))
+
+
+def current_doctor():
+    """The logged-in user's Doctor row, resolved once per request."""
+    if 'current_doctor' not in g:
+        g.current_doctor = cached_row('doctor', current_user.id, Doctor,
+                                      lambda: Doctor.query.filter_by(user_id=current_user.id).first())
+    return g.current_doctor
+
+
+def current_patient():
+    """The logged-in user's Patient row, resolved once per request."""
+    if 'current_patient' not in g:
+        g.current_patient = cached_row('patient', current_user.id, Patient,
+                                       lambda: Patient.query.filter_by(user_id=current_user.id).first())
+    return g.current_patient
+
+
+# -------------------------
+# Change versions and conditional responses
+# -------------------------
+def bump_entity_versions(conn, keys):
+    """Advance the versions of ``keys`` ((kind, entity_id) pairs) on ``conn``; the caller commits."""
+    if not keys:
+        return
+    now = datetime.utcnow()
+    stmt = dialect_insert(EntityVersion)
+    stmt = stmt.on_conflict_do_update(index_elements=['kind', 'entity_id'],
+                                      set_={'version': EntityVersion.version + 1,
+                                            'updated_at': stmt.excluded.updated_at})
+    # a fixed order keeps concurrent writers from locking rows in opposite orders
+    conn.execute(stmt, [{'kind': kind, 'entity_id': entity_id, 'version': 1, 'updated_at': now}
+                        for kind, entity_id in sorted(set(keys))])
+
+
+def version_state(keys):
+    """(token, last_modified) for ``keys``, read in one query; unknown entities are version 0."""
+    rows = db.session.execute(
+        db.select(EntityVersion.kind, EntityVersion.entity_id, EntityVersion.version, EntityVersion.updated_at)
+        .where(or_(*[and_(EntityVersion.kind == kind, EntityVersion.entity_id == entity_id)
+                     for kind, entity_id in keys]))).all()
+    found = {(r.kind, r.entity_id): r for r in rows}
+    token = '.'.join(f'{kind}{entity_id}v{found[(kind, entity_id)].version if (kind, entity_id) in found else 0}'
+                     for kind, entity_id in keys)
+    return token, max((r.updated_at for r in rows), default=None)
+
+
+def make_etag(*parts):
+    return hashlib.sha1(':'.join(str(p) for p in parts).encode('utf-8')).hexdigest()[:24]
+
+
+def not_modified(etag, page=False, last_modified=None):
+    """A 304 response when the client's copy is current, else None.
+
+    ``If-None-Match`` is checked against ``etag``; without it, ``If-Modified-Since``
+    against ``last_modified`` (naive UTC). For rendered pages (``page=True``) never
+    304 while flash messages are pending: the page has to render to show them.
+    """
+    if page and session.get('_flashes'):
+        return None
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = bool(last_modified and request.if_modified_since
+                     and last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since)
+    if not fresh:
+        return None
+    return with_etag(Response(status=304), etag, last_modified)
+
+
+def with_etag(resp, etag, last_modified=None):
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    resp.headers['Cache-Control'] = 'private, no-cache'  # revalidate every time; 304s are cheap
+    return resp
+
+
+# Rendered pages keyed by ETag. The ETag covers the user and the versions the page
+# was built from, so a hit is always current; the TTL only bounds memory.
+page_cache = TTLCache(DEFAULT_CONFIG['PAGE_CACHE_SIZE'], DEFAULT_CONFIG['PAGE_CACHE_TTL'])  # sized by create_app
+
+
+def conditional_page(etag, render):
+    """304 if the client holds ``etag``, else the cached or freshly rendered page."""
+    cached = not_modified(etag, page=True)
+    if cached:
+        return cached
+    flashes = session.get('_flashes')
+    html = TTLCache.MISSING if flashes else page_cache.get(etag)
+    if html is TTLCache.MISSING:
+        html = render()
+        if not flashes:
+            page_cache.set(etag, html)
+    return with_etag(current_app.make_response(html), etag)
+
+
+def conditional_json(keys, build, *extra):
+    """Serve ``build()`` (a response) tagged with the versions of ``keys``, or a 304.
+
+    ``extra`` adds whatever else the body depends on (arguments, the date, ...).
+    """
+    token, last_modified = version_state(keys)
+    etag = make_etag(token, request.full_path, request.accept_mimetypes.best, *extra)
+    cached = not_modified(etag, last_modified=last_modified)
+    if cached:
+        return cached
+    resp = build()
+    if isinstance(resp, tuple) or resp.status_code != 200:
+        return resp
+    return with_etag(resp, etag, last_modified)
+
+
+# -------------------------
+# Doctor directory
+# -------------------------
+DirectoryEntry = namedtuple('DirectoryEntry', 'id name username specialization department department_id active')
+
+
+def directory_entry(doc):
+    """DirectoryEntry for a Doctor whose user and department are loaded."""
+    return DirectoryEntry(doc.id, doc.user.full_name, doc.user.username, doc.specialization,
+                          doc.department.name if doc.department else None, doc.department_id,
+                          bool(doc.user.active))
+
+
+class DirectorySnapshot:
+    """One immutable version of the doctor directory plus what has been rendered from it."""
+
+    def __init__(self, version, doctors):
+        self.version = version
+        self.doctors = tuple(doctors)
+        digest = hashlib.sha1(json.dumps(self.doctors).encode('utf-8')).hexdigest()
+        self.etag = f'dir-{digest[:20]}'
+        self._rendered = {}
+
+    def rendered(self, key, render):
+        """``render()``'s output, produced once per snapshot and ``key``."""
+        if key not in self._rendered:
+            self._rendered[key] = render()
+        return self._rendered[key]
+
+
+class DoctorDirectory:
+    """Process-wide doctor directory, rebuilt with one joined query when it changes.
+
+    Writers call ``invalidate()`` inside their transaction. That drops this
+    process's snapshot at once and bumps the shared ``doctor_directory`` version,
+    which other workers notice within DIRECTORY_RECHECK_SECONDS.
+    """
+    VERSION_KIND = 'doctor_directory'
+
+    def __init__(self):
+        self._snapshot = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot and now - self._checked < current_app.config['DIRECTORY_RECHECK_SECONDS']:
+            return snapshot
+        version = self.version()
+        if not snapshot or snapshot.version != version:
+            with self._lock:
+                snapshot = self._snapshot
+                if not snapshot or snapshot.version != version:
+                    snapshot = self._snapshot = self._build(version)
+        self._checked = now
+        return snapshot
+
+    def _build(self, version):
+        rows = db.session.execute(
+            db.select(Doctor.id, User.full_name, User.username, Doctor.specialization, Department.name,
+                      Doctor.department_id, User.active)
+            .join(User, User.id == Doctor.user_id)
+            .outerjoin(Department, Department.id == Doctor.department_id)
+            .order_by(Doctor.id)).all()
+        return DirectorySnapshot(version, (DirectoryEntry(r[0], r[1], r[2], r[3], r[4], r[5], bool(r[6]))
+                                           for r in rows))
+
+    def version(self):
+        return db.session.execute(db.select(EntityVersion.version).filter_by(
+            kind=self.VERSION_KIND, entity_id=0)).scalar() or 0
+
+    def invalidate(self):
+        bump_entity_versions(db.session.connection(), [(self.VERSION_KIND, 0)])
+        self._snapshot = None
+
+
+doctor_directory = DoctorDirectory()
+
+
+# -------------------------
+# Authentication
+# -------------------------
+@lru_cache(maxsize=8)
+def hash_method_prefix(method):
+    """Fully-qualified method string Werkzeug stores for ``method`` (e.g. 'scrypt:32768:8:1')."""
+    return generate_password_hash('', method=method, salt_length=1).split('$', 1)[0]
+
+
+class VerifierBusy(Exception):
+    pass
+
+
+class PasswordVerifier:
+    """Runs password checks on a bounded worker pool.
+
+    At most PASSWORD_VERIFY_WORKERS hashes run at once, so a login burst cannot
+    occupy every core, and at most PASSWORD_VERIFY_MAX_PENDING may be queued;
+    beyond that callers wait up to PASSWORD_VERIFY_WAIT seconds and then get
+    VerifierBusy. The pool is created lazily per process so it survives forking.
+    """
+
+    def __init__(self):
+        self._pid = None
+        self._pool = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def _ensure_pool(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(max_workers=current_app.config['PASSWORD_VERIFY_WORKERS'],
+                                                    thread_name_prefix='pwcheck')
+                    self._slots = threading.BoundedSemaphore(current_app.config['PASSWORD_VERIFY_MAX_PENDING'])
+                    self._pid = os.getpid()
+
+    def verify(self, pw_hash, pw):
+        self._ensure_pool()
+        if not self._slots.acquire(timeout=current_app.config['PASSWORD_VERIFY_WAIT']):
+            raise VerifierBusy()
+        try:
+            return self._pool.submit(check_password_hash, pw_hash, pw).result()
+        finally:
+            self._slots.release()
+
+
+class TokenBucketLimiter:
+    """In-memory token buckets keyed by an arbitrary string (username, IP, ...).
+
+    Buckets are kept in least-recently-used order and capped at ``max_keys``.
+    Evicting the stalest bucket is O(1), so a spray of distinct keys costs
+    neither a scan nor unbounded memory. An evicted key simply starts again
+    with a full bucket.
+    """
+
+    def __init__(self, burst, refill_per_sec, max_keys=100000):
+        self.burst = burst
+        self.refill_per_sec = refill_per_sec
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.refill_per_sec)
+            allowed = tokens >= cost
+            self._buckets[key] = (tokens - cost if allowed else tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+
+password_verifier = PasswordVerifier()
+login_user_limiter = TokenBucketLimiter(DEFAULT_CONFIG['LOGIN_USER_BURST'], DEFAULT_CONFIG['LOGIN_USER_REFILL_PER_SEC'])
+login_ip_limiter = TokenBucketLimiter(DEFAULT_CONFIG['LOGIN_IP_BURST'], DEFAULT_CONFIG['LOGIN_IP_REFILL_PER_SEC'])
+
+
+# -------------------------
+# Request profiling
+# -------------------------
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def latency_bucket(latency_ms):
+    """Index into LATENCY_BUCKETS_MS (+Inf last) for one latency."""
+    return next((i for i, b in enumerate(LATENCY_BUCKETS_MS) if latency_ms <= b), len(LATENCY_BUCKETS_MS))
+
+
+class EndpointStats:
+    """Cumulative counters plus a rolling window of samples for one endpoint."""
+
+    def __init__(self, window):
+        self.requests = 0
+        self.latency_ms_sum = 0.0
+        self.queries = 0
+        self.sql_ms_sum = 0.0
+        self.n_plus_one = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)  # since start, for Prometheus; last bucket is +Inf
+        self.samples = deque(maxlen=window)  # (latency_ms, queries, sql_ms)
+        self.slowest = []  # (sql_ms, statement), kept sorted, longest first
+        self.n_plus_one_statements = deque(maxlen=10)
+
+    def percentile(self, pct):
+        values = sorted(s[0] for s in self.samples)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(pct / 100 * len(values)))]
+
+    def summary(self):
+        n = len(self.samples) or 1
+        window_buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        for sample in self.samples:
+            window_buckets[latency_bucket(sample[0])] += 1
+        return {
+            'requests': self.requests,
+            'p50_ms': self.percentile(50), 'p95_ms': self.percentile(95), 'p99_ms': self.percentile(99),
+            'mean_queries': round(sum(s[1] for s in self.samples) / n, 2),
+            'mean_sql_ms': round(sum(s[2] for s in self.samples) / n, 3),
+            'n_plus_one': self.n_plus_one,
+            'histogram': dict(zip([str(b) for b in LATENCY_BUCKETS_MS] + ['+Inf'], window_buckets)),
+            'slowest': [{'ms': round(ms, 3), 'statement': st} for ms, st in self.slowest],
+            'n_plus_one_statements': list(self.n_plus_one_statements),
+        }
+
+
+class RequestProfiler:
+    """Collects SQL count/time, slowest statements and N+1 patterns per endpoint."""
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """Hook into engine and request events; a no-op unless SQL_PROFILING is on."""
+        if not app.config['SQL_PROFILING']:
+            return
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def _start_request(self):
+        g.sql_profile = {'start': time.perf_counter(), 'count': 0, 'sql_ms': 0.0, 'statements': {}}
+
+    # The start time lives on the execution context, which is discarded with a
+    # failed statement; a per-connection stack would keep the orphaned entry.
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._profile_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, '_profile_start', None)
+        if start is None or not has_request_context() or 'sql_profile' not in g:
+            return
+        elapsed = (time.perf_counter() - start) * 1000
+        prof = g.sql_profile
+        prof['count'] += 1
+        prof['sql_ms'] += elapsed
+        entry = prof['statements'].setdefault(statement, {'count': 0, 'ms': 0.0, 'params': set()})
+        entry['count'] += 1
+        entry['ms'] += elapsed
+        if len(entry['params']) < 2:
+            entry['params'].add(repr(parameters))
+
+    def _finish_request(self, response):
+        prof = g.get('sql_profile')
+        if prof is None:
+            return response
+        app = current_app._get_current_object()
+        if app.debug:
+            # headers go out before a streamed body runs its queries; these cover the view only
+            response.headers['X-Request-Time-Ms'] = f"{(time.perf_counter() - prof['start']) * 1000:.2f}"
+            response.headers['X-SQL-Query-Count'] = str(prof['count'])
+            response.headers['X-SQL-Time-Ms'] = f"{prof['sql_ms']:.2f}"
+        # Streamed responses (exports, NDJSON) query while the body is produced, after
+        # this hook; g.sql_profile keeps collecting until the server closes the response.
+        endpoint, method, path = request.endpoint or 'unmatched', request.method, request.path
+        response.call_on_close(lambda: self._record(app, endpoint, method, path, prof))
+        return response
+
+    def _record(self, app, endpoint, method, path, prof):
+        latency_ms = (time.perf_counter() - prof['start']) * 1000
+        threshold = app.config['N_PLUS_ONE_THRESHOLD']
+        repeated = [st for st, e in prof['statements'].items() if e['count'] >= threshold and len(e['params']) > 1]
+        slowest = sorted(((e['ms'], st) for st, e in prof['statements'].items()), reverse=True)
+        keep = app.config['PROFILING_SLOW_STATEMENTS']
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats(app.config['PROFILING_WINDOW'])
+            stats.requests += 1
+            stats.latency_ms_sum += latency_ms
+            stats.queries += prof['count']
+            stats.sql_ms_sum += prof['sql_ms']
+            stats.buckets[latency_bucket(latency_ms)] += 1
+            stats.samples.append((latency_ms, prof['count'], prof['sql_ms']))
+            if repeated:
+                stats.n_plus_one += 1
+                stats.n_plus_one_statements.extend(st[:300] for st in repeated)
+            stats.slowest = sorted(stats.slowest + [(ms, st[:300]) for ms, st in slowest[:keep]], reverse=True)[:keep]
+        if latency_ms >= app.config['SLOW_REQUEST_MS']:
+            app.logger.warning('slow request %s %s: %.1f ms, %d queries (%.1f ms SQL)%s', method, path,
+                               latency_ms, prof['count'], prof['sql_ms'],
+                               f', N+1: {repeated[0][:120]}' if repeated else '')
+
+    def snapshot(self):
+        with self.lock:
+            return {name: stats.summary() for name, stats in sorted(self.endpoints.items())}
+
+    def prometheus(self):
+        """Render the collected metrics in the Prometheus text exposition format."""
+        lines = ['# TYPE hms_request_duration_seconds histogram']
+        with self.lock:
+            items = sorted(self.endpoints.items())
+            for name, st in items:
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS_MS + ('+Inf',), st.buckets):
+                    cumulative += n
+                    le = '+Inf' if bound == '+Inf' else f'{bound / 1000:g}'
+                    lines.append(f'hms_request_duration_seconds_bucket{{endpoint="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'hms_request_duration_seconds_sum{{endpoint="{name}"}} {st.latency_ms_sum / 1000:.6f}')
+                lines.append(f'hms_request_duration_seconds_count{{endpoint="{name}"}} {st.requests}')
+            for metric, kind, attr, scale in (('hms_sql_queries_total', 'counter', 'queries', 1),
+                                              ('hms_sql_duration_seconds_total', 'counter', 'sql_ms_sum', 1000),
+                                              ('hms_n_plus_one_requests_total', 'counter', 'n_plus_one', 1)):
+                lines.append(f'# TYPE {metric} {kind}')
+                for name, st in items:
+                    lines.append(f'{metric}{{endpoint="{name}"}} {getattr(st, attr) / scale:g}')
+        cache = profile_cache.stats()
+        lines += ['# TYPE hms_profile_cache_hits_total counter', f"hms_profile_cache_hits_total {cache['hits']}",
+                  '# TYPE hms_profile_cache_misses_total counter', f"hms_profile_cache_misses_total {cache['misses']}"]
+        return '\n'.join(lines) + '\n'
+
+
+profiler = RequestProfiler()
+
 
 # -------------------------
 # Login manager
 # -------------------------
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    return cached_row('user', user_id, User, lambda: db.session.get(User, user_id))
 
 
 # -------------------------
@@ -120,57 +1189,1469 @@ def next_n_dates(n=7):
     return [(base + timedelta(days=i)) for i in range(n)]
 
 
+def doctor_slots(doctor_id, dates):
+    """Return {'YYYY-MM-DD': [times]} for the given doctor and dates, expanded from their rules."""
+    return compiled_schedule(doctor_id).expand(dates)
+
+
+def migrate_availability_json():
+    """Move legacy ``Doctor.availability_json`` blobs into AvailabilitySlot rows.
+
+    Idempotent: slots that already exist are kept, and each blob is cleared
+    once it has been migrated. Returns the number of slots created.
+    """
+    created = 0
+    touched = {}
+    for doc in Doctor.query.filter(Doctor.availability_json.isnot(None)).all():
+        try:
+            availability = json.loads(doc.availability_json or '{}')
+        except ValueError:
+            availability = {}
+        existing = {(d.isoformat(), t) for d, t in db.session.execute(
+            db.select(AvailabilitySlot.date, AvailabilitySlot.time).where(AvailabilitySlot.doctor_id == doc.id))}
+        for date_str, times in availability.items():
+            try:
+                slot_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+            except ValueError:
+                continue
+            for t in times:
+                if (date_str, t) not in existing:
+                    existing.add((date_str, t))
+                    db.session.add(AvailabilitySlot(doctor_id=doc.id, date=slot_date, time=t))
+                    touched.setdefault(doc.id, set()).add(slot_date)
+                    created += 1
+        doc.availability_json = None
+    db.session.flush()
+    for doctor_id, dates in touched.items():
+        refresh_occupancy_slots(doctor_id, dates)
+    db.session.commit()
+    return created
+
+
+# -------------------------
+# Recurring availability
+# -------------------------
+# Doctors keep weekly AvailabilityRule rows plus date-specific exceptions. A
+# doctor's rules are compiled once into a DoctorSchedule, cached per process and
+# checked against the shared ('schedule', doctor_id) version, and expanded lazily
+# per day. Booking pages and validation read the schedule; availability_slot
+# holds the expansion over AVAILABILITY_HORIZON_DAYS for the SQL-side free-slot
+# search and the occupancy counters.
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+SCHEDULE_VERSION_KIND = 'schedule'
+
+
+def parse_clock(value):
+    """Minutes after midnight for ``HH:MM``; raises ValueError."""
+    parsed = datetime.strptime((value or '').strip(), '%H:%M')
+    return parsed.hour * 60 + parsed.minute
+
+
+def slot_times(start_time, end_time, slot_minutes):
+    """``HH:MM`` start times of the slots that fit in [start_time, end_time)."""
+    start, end = parse_clock(start_time), parse_clock(end_time)
+    return tuple(f'{m // 60:02d}:{m % 60:02d}' for m in range(start, end - slot_minutes + 1, slot_minutes))
+
+
+def rule_from_form(form):
+    """AvailabilityRule fields from a submitted form; raises ValueError."""
+    weekday = int(form.get('weekday', ''))
+    slot_minutes = int(form.get('slot_minutes') or 30)
+    start_time, end_time = form.get('start_time', '').strip(), form.get('end_time', '').strip()
+    valid_from = datetime.strptime(form['valid_from'], '%Y-%m-%d').date() if form.get('valid_from') else None
+    valid_until = datetime.strptime(form['valid_until'], '%Y-%m-%d').date() if form.get('valid_until') else None
+    if not 0 <= weekday <= 6:
+        raise ValueError('weekday must be 0 (Monday) to 6 (Sunday)')
+    if not 5 <= slot_minutes <= 480:
+        raise ValueError('slot length must be between 5 and 480 minutes')
+    if parse_clock(end_time) - parse_clock(start_time) < slot_minutes:
+        raise ValueError('the time range must fit at least one slot')
+    if valid_from and valid_until and valid_until < valid_from:
+        raise ValueError('valid until must not be before valid from')
+    return {'weekday': weekday, 'start_time': start_time, 'end_time': end_time, 'slot_minutes': slot_minutes,
+            'valid_from': valid_from, 'valid_until': valid_until}
+
+
+class DoctorSchedule:
+    """A doctor's rules and exceptions, compiled for expansion.
+
+    Each rule's slot times are computed once here; expanding a day is then a
+    weekday lookup plus that day's exceptions, memoized per day. A 90-day
+    window costs the same per day as a 7-day one and nothing is parsed per
+    request.
+    """
+    MAX_MEMO_DAYS = 4096
+
+    def __init__(self, version, rules, exceptions):
+        self.version = version
+        # once a doctor keeps any rules or exceptions, a day without slots is a day off
+        self.has_rules = bool(rules or exceptions)
+        self._weekly = {}
+        for r in rules:
+            self._weekly.setdefault(r.weekday, []).append(
+                (r.valid_from, r.valid_until, slot_times(r.start_time, r.end_time, r.slot_minutes)))
+        self._added, self._removed, self._days_off = {}, {}, set()
+        for e in exceptions:
+            if e.kind == 'add':
+                self._added.setdefault(e.date, set()).add(e.time)
+            elif e.time:
+                self._removed.setdefault(e.date, set()).add(e.time)
+            else:
+                self._days_off.add(e.date)
+        self._days = {}
+
+    def day(self, day):
+        """Sorted slot times offered on ``day``."""
+        times = self._days.get(day)
+        if times is None:
+            found = set()
+            if day not in self._days_off:
+                for valid_from, valid_until, rule_times in self._weekly.get(day.weekday(), ()):
+                    if (valid_from is None or valid_from <= day) and (valid_until is None or day <= valid_until):
+                        found.update(rule_times)
+            found -= self._removed.get(day, set())
+            found |= self._added.get(day, set())
+            times = tuple(sorted(found))
+            if len(self._days) >= self.MAX_MEMO_DAYS:
+                self._days.clear()
+            self._days[day] = times
+        return times
+
+    def expand(self, dates):
+        """{'YYYY-MM-DD': [times]} for the days in ``dates`` that have slots."""
+        out = {}
+        for d in dates:
+            times = self.day(d)
+            if times:
+                out[d.isoformat()] = list(times)
+        return out
+
+
+# doctor_id -> (DoctorSchedule, monotonic time its version was last checked); sized by create_app
+schedule_cache = TTLCache(DEFAULT_CONFIG['SCHEDULE_CACHE_SIZE'], DEFAULT_CONFIG['SCHEDULE_CACHE_TTL'])
+
+
+def schedule_version(doctor_id):
+    return db.session.execute(db.select(EntityVersion.version).filter_by(
+        kind=SCHEDULE_VERSION_KIND, entity_id=doctor_id)).scalar() or 0
+
+
+def compiled_schedule(doctor_id):
+    """The doctor's compiled schedule, rebuilt when their shared schedule version moves."""
+    entry = schedule_cache.get(doctor_id)
+    now = time.monotonic()
+    if entry is not TTLCache.MISSING and now - entry[1] < current_app.config['SCHEDULE_RECHECK_SECONDS']:
+        return entry[0]
+    version = schedule_version(doctor_id)
+    if entry is not TTLCache.MISSING and entry[0].version == version:
+        schedule = entry[0]
+    else:
+        schedule = DoctorSchedule(
+            version,
+            db.session.execute(db.select(AvailabilityRule).filter_by(doctor_id=doctor_id)).scalars().all(),
+            db.session.execute(db.select(AvailabilityException).filter_by(doctor_id=doctor_id)).scalars().all())
+    schedule_cache.set(doctor_id, (schedule, now))
+    return schedule
+
+
+def slot_offered(doctor_id, day, slot_time):
+    """Whether ``slot_time`` on ``day`` may be booked with the doctor.
+
+    Doctors who have never set up a schedule accept any time, as before rules
+    existed; everyone else only the times their schedule offers that day.
+    """
+    schedule = compiled_schedule(doctor_id)
+    return not schedule.has_rules or slot_time in schedule.day(day)
+
+
+def invalidate_schedule(doctor_id):
+    """Call inside the transaction that changes a doctor's rules or exceptions."""
+    bump_entity_versions(db.session.connection(), [(SCHEDULE_VERSION_KIND, doctor_id)])
+    schedule_cache.invalidate(doctor_id)
+
+
+def materialize_availability(doctor_ids=None, start=None, days=None):
+    """Bring availability_slot in line with the rules over [start, start + days).
+
+    Only the difference is written, so a daily run that just rolls the horizon
+    forward touches one day per doctor. Slots outside the window are left
+    alone. Returns (inserted, deleted).
+    """
+    start = start or date.today()
+    days = days or current_app.config['AVAILABILITY_HORIZON_DAYS']
+    window = [start + timedelta(days=i) for i in range(days)]
+    end = window[-1]
+    if doctor_ids is None:
+        doctor_ids = db.session.execute(db.select(Doctor.id)).scalars().all()
+    inserted = deleted = 0
+    for doctor_id in doctor_ids:
+        schedule = compiled_schedule(doctor_id)
+        expected = {(d, t) for d in window for t in schedule.day(d)}
+        existing = {(d, t): slot_id for slot_id, d, t in db.session.execute(
+            db.select(AvailabilitySlot.id, AvailabilitySlot.date, AvailabilitySlot.time)
+            .where(AvailabilitySlot.doctor_id == doctor_id, AvailabilitySlot.date.between(start, end)))}
+        missing = expected - existing.keys()
+        stale = [key for key in existing if key not in expected]
+        for batch in chunked(missing, current_app.config['BULK_BATCH_SIZE']):
+            db.session.execute(db.insert(AvailabilitySlot),
+                               [{'doctor_id': doctor_id, 'date': d, 'time': t} for d, t in batch])
+        for batch in chunked(stale, SQL_IN_CHUNK):
+            db.session.execute(db.delete(AvailabilitySlot).where(
+                AvailabilitySlot.id.in_([existing[key] for key in batch])))
+        if missing or stale:
+            refresh_occupancy_slots(doctor_id, {d for d, _ in missing} | {d for d, _ in stale})
+        inserted += len(missing)
+        deleted += len(stale)
+    db.session.commit()
+    return inserted, deleted
+
+
+def migrate_slots_to_rules():
+    """Keep hand-entered upcoming slots of doctors without rules as ``add`` exceptions.
+
+    Idempotent; returns the number of exceptions created.
+    """
+    ruled = db.select(AvailabilityRule.doctor_id).distinct()
+    rows = db.session.execute(
+        db.select(AvailabilitySlot.doctor_id, AvailabilitySlot.date, AvailabilitySlot.time)
+        .where(AvailabilitySlot.date >= date.today(), AvailabilitySlot.doctor_id.not_in(ruled))).all()
+    existing = set(db.session.execute(
+        db.select(AvailabilityException.doctor_id, AvailabilityException.date, AvailabilityException.time)
+        .where(AvailabilityException.kind == 'add', AvailabilityException.date >= date.today())))
+    new = [{'doctor_id': doctor_id, 'date': d, 'time': t, 'kind': 'add'}
+           for doctor_id, d, t in rows if (doctor_id, d, t) not in existing]
+    for batch in chunked(new, current_app.config['BULK_BATCH_SIZE']):
+        db.session.execute(db.insert(AvailabilityException), batch)
+    for doctor_id in {r['doctor_id'] for r in new}:
+        invalidate_schedule(doctor_id)
+    db.session.commit()
+    return len(new)
+
+
+def free_slots_stmt(date_from, date_to, department=None, department_id=None, doctor_id=None, time=None):
+    """Open slots of active doctors in a date range.
+
+    Slots are anti-joined against appointments on (doctor_id, date, time), so
+    the lookup is served by the ``uix_doctor_datetime`` index. Cancelled
+    appointments still hold that key and therefore still occupy the slot.
+    Slots someone is in the middle of booking (an unexpired hold) are hidden too.
+    """
+    booked = db.select(Appointment.id).where(Appointment.doctor_id == AvailabilitySlot.doctor_id,
+                                             Appointment.date == AvailabilitySlot.date,
+                                             Appointment.time == AvailabilitySlot.time)
+    held = db.select(SlotHold.id).where(SlotHold.doctor_id == AvailabilitySlot.doctor_id,
+                                        SlotHold.date == AvailabilitySlot.date,
+                                        SlotHold.time == AvailabilitySlot.time,
+                                        SlotHold.expires_at > datetime.utcnow())
+    stmt = (db.select(AvailabilitySlot.doctor_id, AvailabilitySlot.date, AvailabilitySlot.time,
+                      User.full_name.label('doctor'), Doctor.specialization, Department.name.label('department'))
+            .join(Doctor, Doctor.id == AvailabilitySlot.doctor_id)
+            .join(User, User.id == Doctor.user_id)
+            .outerjoin(Department, Department.id == Doctor.department_id)
+            .where(AvailabilitySlot.date >= date_from, AvailabilitySlot.date <= date_to,
+                   User.active.is_(True), ~booked.exists(), ~held.exists())
+            .order_by(AvailabilitySlot.date, AvailabilitySlot.time, AvailabilitySlot.doctor_id))
+    if department:
+        stmt = stmt.where(func.lower(Department.name) == department.lower())
+    if department_id:
+        stmt = stmt.where(Doctor.department_id == department_id)
+    if doctor_id:
+        stmt = stmt.where(AvailabilitySlot.doctor_id == doctor_id)
+    if time:
+        stmt = stmt.where(AvailabilitySlot.time == time)
+    return stmt
+
+
+def search_index_available():
+    """True when the FTS5 index exists (SQLite); other backends fall back to ILIKE scans."""
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    return db.session.execute(db.text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_fts'")).first() is not None
+
+
+def search_match_expr(terms, columns):
+    """FTS5 MATCH expression: every word of ``terms`` as a prefix query within ``columns``."""
+    words = re.findall(r'\w+', terms or '')
+    if not words:
+        return None
+    return '{%s} : (%s)' % (' '.join(columns), ' '.join(f'"{w}"*' for w in words))
+
+
+SEARCH_LIKE_COLUMNS = {
+    'full_name': User.full_name,
+    'username': User.username,
+    'contact': User.contact,
+    'specialization': Doctor.specialization,
+    'department': Department.name,
+}
+
+
+def search_directory(kind, filters, page=1):
+    """Ranked, paginated doctor or patient search.
+
+    ``filters`` is a list of (terms, columns); all non-empty filters must match.
+    Returns (results, has_next) with doctor/patient rows and their users eager-loaded.
+    """
+    model = Doctor if kind == 'doctor' else Patient
+    page_size = current_app.config['SEARCH_PAGE_SIZE']
+    offset = (max(page, 1) - 1) * page_size
+    query = model.query.options(joinedload(model.user))
+    if model is Doctor:
+        query = query.options(joinedload(Doctor.department))
+    filters = [(terms, columns) for terms, columns in filters if search_match_expr(terms, columns)]
+    if not filters:
+        results = query.order_by(model.id).offset(offset).limit(page_size + 1).all()
+    elif search_index_available():
+        match = ' AND '.join(f'({search_match_expr(terms, columns)})' for terms, columns in filters)
+        ids = db.session.execute(db.text(
+            f'SELECT entity_id FROM search_fts WHERE search_fts MATCH :match AND kind = :kind '
+            f'ORDER BY {SEARCH_RANK} LIMIT :limit OFFSET :offset'),
+            {'match': match, 'kind': kind, 'limit': page_size + 1, 'offset': offset}).scalars().all()
+        by_id = {obj.id: obj for obj in query.filter(model.id.in_(ids)).all()} if ids else {}
+        results = [by_id[i] for i in ids if i in by_id]
+    else:
+        query = query.join(User, User.id == model.user_id)
+        if model is Doctor:
+            query = query.outerjoin(Department, Department.id == Doctor.department_id)
+        for terms, columns in filters:
+            query = query.filter(or_(*[SEARCH_LIKE_COLUMNS[c].ilike(f'%{terms}%') for c in columns]))
+        results = query.order_by(model.id).offset(offset).limit(page_size + 1).all()
+    return results[:page_size], len(results) > page_size
+
+
+def encode_cursor(appt_date, appt_id):
+    """Keyset cursor for listings ordered by (date desc, id desc)."""
+    return f'{appt_date.isoformat()}_{appt_id}'
+
+
+def decode_cursor(cursor):
+    """Return (date, id) from a cursor string, or None if it is missing/invalid."""
+    if not cursor:
+        return None
+    try:
+        date_str, id_str = cursor.split('_', 1)
+        return datetime.strptime(date_str, '%Y-%m-%d').date(), int(id_str)
+    except ValueError:
+        return None
+
+
+def dashboard_stats():
+    """Headline counts plus per-status and per-department appointment breakdowns.
+
+    Appointment figures are summed from the reporting rollups, so they include
+    archived history and never scan the appointment table.
+    """
+    doctors, patients = db.session.execute(db.select(
+        db.select(func.count(Doctor.id)).scalar_subquery(),
+        db.select(func.count(Patient.id)).scalar_subquery())).one()
+    rows = db.session.execute(
+        db.select(AppointmentRollup.status, Department.name, func.sum(AppointmentRollup.appointments))
+        .outerjoin(Department, Department.id == AppointmentRollup.department_id)
+        .group_by(AppointmentRollup.status, Department.name)
+    ).all()
+    stats = {'doctors': doctors, 'patients': patients, 'appointments': 0, 'by_status': {}, 'by_department': {}}
+    for status, dept, n in rows:
+        if not n:
+            continue
+        stats['appointments'] += n
+        stats['by_status'][status] = stats['by_status'].get(status, 0) + n
+        stats['by_department'][dept or 'Unassigned'] = stats['by_department'].get(dept or 'Unassigned', 0) + n
+    return stats
+
+
+# -------------------------
+# Slot holds
+# -------------------------
+# A patient may take a hold on (doctor, date, time) through /doctor/<id>/hold while
+# filling in the booking. Only that endpoint writes holds; booking paths just read
+# them, refuse a slot another patient holds live, and release the booker's own.
+_last_hold_sweep = [0.0]
+
+
+def active_hold(doctor_id, slot_date, slot_time):
+    """The unexpired hold on this slot, if any."""
+    return SlotHold.query.filter(SlotHold.doctor_id == doctor_id, SlotHold.date == slot_date,
+                                 SlotHold.time == slot_time, SlotHold.expires_at > datetime.utcnow()).first()
+
+
+def acquire_hold(doctor_id, slot_date, slot_time, patient_id):
+    """Take ``patient_id``'s hold on a slot and commit it.
+
+    Returns the expiry time, or None when another patient holds the slot.
+    Holding a slot again keeps the original expiry, and taking a new slot
+    drops the patient's other hold with the same doctor, so nobody can hide
+    more than one slot per doctor or keep one hidden indefinitely. Expired
+    holds are taken over in place.
+    """
+    maybe_sweep_holds()
+    holder = active_hold(doctor_id, slot_date, slot_time)
+    if holder:
+        return holder.expires_at if holder.patient_id == patient_id else None
+    db.session.execute(db.delete(SlotHold).where(SlotHold.doctor_id == doctor_id,
+                                                 SlotHold.patient_id == patient_id))
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=current_app.config['SLOT_HOLD_TTL'])
+    stmt = dialect_insert(SlotHold).values(doctor_id=doctor_id, date=slot_date, time=slot_time,
+                                           patient_id=patient_id, expires_at=expires_at)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['doctor_id', 'date', 'time'],
+        set_={'patient_id': stmt.excluded.patient_id, 'expires_at': stmt.excluded.expires_at},
+        # someone may have taken it between the check above and this statement
+        where=SlotHold.expires_at <= now,
+    ).returning(SlotHold.id)
+    acquired = db.session.execute(stmt).first() is not None
+    db.session.commit()
+    return expires_at if acquired else None
+
+
+def release_hold(doctor_id, slot_date, slot_time, patient_id):
+    """Drop ``patient_id``'s hold on a slot; the caller commits."""
+    db.session.execute(db.delete(SlotHold).where(SlotHold.doctor_id == doctor_id, SlotHold.date == slot_date,
+                                                 SlotHold.time == slot_time, SlotHold.patient_id == patient_id))
+
+
+def sweep_expired_holds():
+    removed = db.session.execute(db.delete(SlotHold).where(SlotHold.expires_at <= datetime.utcnow())).rowcount
+    db.session.commit()
+    return removed
+
+
+def maybe_sweep_holds():
+    """Sweep expired holds at most once per SLOT_HOLD_SWEEP_INTERVAL in this process.
+
+    Expired holds are already ignored by every read, so this only keeps the table small.
+    """
+    now = time.monotonic()
+    if now - _last_hold_sweep[0] >= current_app.config['SLOT_HOLD_SWEEP_INTERVAL']:
+        _last_hold_sweep[0] = now
+        sweep_expired_holds()
+
+
+def bookable_slots(doctor_id, dates, patient_id):
+    """{'YYYY-MM-DD': [times]} a patient can still book: not taken, not held by someone else."""
+    taken = {(d, t) for d, t in db.session.execute(
+        db.select(Appointment.date, Appointment.time)
+        .where(Appointment.doctor_id == doctor_id, Appointment.date.in_(list(dates))))}
+    taken.update(db.session.execute(
+        db.select(SlotHold.date, SlotHold.time)
+        .where(SlotHold.doctor_id == doctor_id, SlotHold.date.in_(list(dates)),
+               SlotHold.expires_at > datetime.utcnow(), SlotHold.patient_id != patient_id)))
+    out = {}
+    for date_str, times in doctor_slots(doctor_id, dates).items():
+        slot_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+        open_times = [t for t in times if (slot_date, t) not in taken]
+        if open_times:
+            out[date_str] = open_times
+    return out
+
+
+# -------------------------
+# Write-time counters (schedule occupancy, reporting rollups)
+# -------------------------
+OCCUPANCY_COLUMNS = {'Booked': 'booked', 'Completed': 'completed', 'Cancelled': 'cancelled'}
+# Counters cover archived history too, so rebuilds read both tiers.
+ALL_APPOINTMENTS = ("SELECT id, doctor_id, date, status FROM appointment "
+                    "UNION ALL SELECT id, doctor_id, date, status FROM appointment_archive")
+ALL_TREATMENTS = ("SELECT appointment_id, created_at FROM treatment "
+                  "UNION ALL SELECT appointment_id, created_at FROM treatment_archive")
+
+
+def upsert_counters(conn, model, keys, deltas):
+    """Add ``deltas`` ({key_tuple: {column: n}}) to counter rows of ``model`` unique on ``keys``."""
+    table = model.__table__
+    counters = [c.name for c in table.c if c.name != 'id' and c.name not in keys]
+    for key, cols in deltas.items():
+        cols = {c: n for c, n in cols.items() if n}
+        if not cols:
+            continue
+        values = dict.fromkeys(counters, 0)
+        values.update(zip(keys, key))
+        values.update(cols)
+        stmt = dialect_insert(model).values(**values)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=keys, set_={col: table.c[col] + stmt.excluded[col] for col in cols}))
+
+
+def doctor_departments(conn, doctor_ids):
+    """{doctor_id: department_id or 0} read on ``conn`` (usable inside flush events)."""
+    if not doctor_ids:
+        return {}
+    rows = conn.execute(db.select(Doctor.id, Doctor.department_id).where(Doctor.id.in_(list(doctor_ids))))
+    return {doc_id: dept_id or 0 for doc_id, dept_id in rows}
+
+
+def record_appointment_changes(conn, changes):
+    """Apply appointment count changes, a list of (doctor_id, date, status, +n/-n).
+
+    Updates both the occupancy counters and the reporting rollups.
+    """
+    occupancy, rollup = {}, {}
+    departments = doctor_departments(conn, {c[0] for c in changes})
+    for doctor_id, day, status, n in changes:
+        if not doctor_id or not day:
+            continue
+        status = status or 'Booked'
+        col = OCCUPANCY_COLUMNS.get(status)
+        if col:
+            counts = occupancy.setdefault((doctor_id, day), {})
+            counts[col] = counts.get(col, 0) + n
+        counts = rollup.setdefault((day, doctor_id, departments.get(doctor_id, 0), status), {})
+        counts['appointments'] = counts.get('appointments', 0) + n
+    upsert_counters(conn, DoctorOccupancy, ['doctor_id', 'date'], occupancy)
+    upsert_counters(conn, AppointmentRollup, ['day', 'doctor_id', 'department_id', 'status'], rollup)
+
+
+def record_new_treatments(conn, treatments):
+    """Count new treatments, a list of (appointment_id, created day), into the rollups."""
+    if not treatments:
+        return
+    owners = {appt_id: (doc_id, dept_id or 0) for appt_id, doc_id, dept_id in conn.execute(
+        db.select(Appointment.id, Appointment.doctor_id, Doctor.department_id)
+        .join(Doctor, Doctor.id == Appointment.doctor_id)
+        .where(Appointment.id.in_({t[0] for t in treatments})))}
+    deltas = {}
+    for appt_id, day in treatments:
+        if appt_id in owners:
+            key = (day,) + owners[appt_id]
+            deltas.setdefault(key, {'treatments': 0})['treatments'] += 1
+    upsert_counters(conn, TreatmentRollup, ['day', 'doctor_id', 'department_id'], deltas)
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_appointment_writes(session, flush_context):
+    """Keep the occupancy counters, reporting rollups and entity versions in step with ORM writes.
+
+    Covers appointment inserts, changes and deletes, and new or edited treatments.
+    """
+    changes, treatments, touched, treated = [], [], set(), set()
+    for obj in session.new:
+        if isinstance(obj, Appointment):
+            changes.append((obj.doctor_id, obj.date, obj.status, 1))
+            touched.update({('patient', obj.patient_id), ('doctor', obj.doctor_id)})
+        elif isinstance(obj, Treatment):
+            treatments.append((obj.appointment_id, (obj.created_at or datetime.utcnow()).date()))
+            treated.add(obj.appointment_id)
+    for obj in session.dirty:
+        if isinstance(obj, Appointment) and session.is_modified(obj, include_collections=False):
+            hist = db.inspect(obj).attrs.status.history
+            if hist.deleted and hist.added:
+                changes.append((obj.doctor_id, obj.date, hist.deleted[0], -1))
+                changes.append((obj.doctor_id, obj.date, hist.added[0], 1))
+            touched.update({('patient', obj.patient_id), ('doctor', obj.doctor_id)})
+        elif isinstance(obj, Treatment) and session.is_modified(obj, include_collections=False):
+            treated.add(obj.appointment_id)
+    for obj in session.deleted:
+        if isinstance(obj, Appointment):
+            changes.append((obj.doctor_id, obj.date, obj.status, -1))
+            touched.update({('patient', obj.patient_id), ('doctor', obj.doctor_id)})
+    conn = session.connection() if changes or treatments or touched or treated else None
+    if changes:
+        record_appointment_changes(conn, changes)
+    if treatments:
+        record_new_treatments(conn, treatments)
+    if treated:
+        touched.update(appointment_owners(conn, treated))
+    bump_entity_versions(conn, touched)
+
+
+def appointment_owners(conn, appointment_ids):
+    """('patient', id) and ('doctor', id) keys for the given appointments."""
+    keys = set()
+    for chunk in chunked(appointment_ids, SQL_IN_CHUNK):
+        for patient_id, doctor_id in conn.execute(db.select(Appointment.patient_id, Appointment.doctor_id)
+                                                  .where(Appointment.id.in_(chunk))):
+            keys.update({('patient', patient_id), ('doctor', doctor_id)})
+    return keys
+
+
+def refresh_occupancy_slots(doctor_id, dates):
+    """Recount the availability slots behind the counters for ``dates``."""
+    dates = list(dates)
+    counts = dict(db.session.execute(
+        db.select(AvailabilitySlot.date, func.count(AvailabilitySlot.id))
+        .where(AvailabilitySlot.doctor_id == doctor_id, AvailabilitySlot.date.in_(dates))
+        .group_by(AvailabilitySlot.date)).all())
+    for day in dates:
+        stmt = dialect_insert(DoctorOccupancy).values(doctor_id=doctor_id, date=day, slots=counts.get(day, 0),
+                                                      booked=0, completed=0, cancelled=0)
+        db.session.execute(stmt.on_conflict_do_update(index_elements=['doctor_id', 'date'],
+                                                      set_={'slots': stmt.excluded.slots}))
+    bump_entity_versions(db.session.connection(), [('doctor', doctor_id)])
+
+
+def rebuild_occupancy():
+    """Recompute every occupancy counter from the appointment and slot tables."""
+    db.session.execute(db.delete(DoctorOccupancy))
+    db.session.execute(db.text(
+        "INSERT INTO doctor_occupancy (doctor_id, date, slots, booked, completed, cancelled) "
+        "SELECT doctor_id, date, SUM(slots), SUM(booked), SUM(completed), SUM(cancelled) FROM ("
+        " SELECT doctor_id, date, COUNT(*) AS slots, 0 AS booked, 0 AS completed, 0 AS cancelled "
+        " FROM availability_slot GROUP BY doctor_id, date"
+        " UNION ALL"
+        " SELECT doctor_id, date, 0,"
+        "  SUM(CASE WHEN status = 'Booked' OR status IS NULL THEN 1 ELSE 0 END),"
+        "  SUM(CASE WHEN status = 'Completed' THEN 1 ELSE 0 END),"
+        "  SUM(CASE WHEN status = 'Cancelled' THEN 1 ELSE 0 END)"
+        f" FROM ({ALL_APPOINTMENTS}) AS a GROUP BY doctor_id, date"
+        ") AS counts GROUP BY doctor_id, date"))
+    db.session.commit()
+
+
+def parse_schedule_window(args):
+    """(start, end, view) from ``?view=day|week|range&start=&end=``; raises ValueError."""
+    view = args.get('view', 'week')
+    start = datetime.strptime(args['start'], '%Y-%m-%d').date() if args.get('start') else date.today()
+    if view == 'day':
+        end = start
+    elif view == 'week':
+        end = start + timedelta(days=6)
+    elif view == 'range':
+        end = datetime.strptime(args['end'], '%Y-%m-%d').date() if args.get('end') else start + timedelta(days=6)
+    else:
+        raise ValueError('view must be day, week or range')
+    if end < start:
+        raise ValueError('end must not be before start')
+    if (end - start).days >= current_app.config['SCHEDULE_MAX_DAYS']:
+        raise ValueError(f"window is limited to {current_app.config['SCHEDULE_MAX_DAYS']} days")
+    return start, end, view
+
+
+def doctor_window(doctor_id, start, end):
+    """Appointments (patients eager-loaded) in [start, end]."""
+    return (Appointment.query
+            .options(joinedload(Appointment.patient).joinedload(Patient.user))
+            .filter(Appointment.doctor_id == doctor_id, Appointment.date >= start, Appointment.date <= end)
+            .order_by(Appointment.date, Appointment.time).all())
+
+
+def occupancy_days(doctor_id, start, end):
+    """One summary dict per day in [start, end], read from the occupancy counters only."""
+    rows = {o.date: o for o in DoctorOccupancy.query.filter(
+        DoctorOccupancy.doctor_id == doctor_id, DoctorOccupancy.date >= start, DoctorOccupancy.date <= end)}
+    days = []
+    for i in range((end - start).days + 1):
+        day = start + timedelta(days=i)
+        o = rows.get(day)
+        days.append({'date': day.isoformat(), 'slots': o.slots if o else 0, 'booked': o.booked if o else 0,
+                     'completed': o.completed if o else 0, 'cancelled': o.cancelled if o else 0,
+                     'free': o.free if o else 0})
+    return days
+
+
+def rebuild_rollups():
+    """Recompute the reporting rollups from the appointment and treatment tables (backfill)."""
+    db.session.execute(db.delete(AppointmentRollup))
+    db.session.execute(db.delete(TreatmentRollup))
+    db.session.execute(db.text(
+        "INSERT INTO appointment_rollup (day, doctor_id, department_id, status, appointments) "
+        "SELECT a.date, a.doctor_id, COALESCE(d.department_id, 0), COALESCE(a.status, 'Booked'), COUNT(*) "
+        f"FROM ({ALL_APPOINTMENTS}) AS a JOIN doctor d ON d.id = a.doctor_id "
+        "GROUP BY a.date, a.doctor_id, COALESCE(d.department_id, 0), COALESCE(a.status, 'Booked')"))
+    db.session.execute(db.text(
+        "INSERT INTO treatment_rollup (day, doctor_id, department_id, treatments) "
+        "SELECT DATE(t.created_at), a.doctor_id, COALESCE(d.department_id, 0), COUNT(*) "
+        f"FROM ({ALL_TREATMENTS}) AS t JOIN ({ALL_APPOINTMENTS}) AS a ON a.id = t.appointment_id "
+        "JOIN doctor d ON d.id = a.doctor_id "
+        "GROUP BY DATE(t.created_at), a.doctor_id, COALESCE(d.department_id, 0)"))
+    db.session.commit()
+
+
+def report_range(args):
+    """(date_from, date_to) from ``args``; defaults to the last 30 days. Raises ValueError."""
+    date_to = datetime.strptime(args['date_to'], '%Y-%m-%d').date() if args.get('date_to') else date.today()
+    date_from = datetime.strptime(args['date_from'], '%Y-%m-%d').date() if args.get('date_from') \
+        else date_to - timedelta(days=29)
+    if date_from > date_to:
+        raise ValueError('date_from must not be after date_to')
+    return date_from, date_to
+
+
+def department_report(date_from, date_to):
+    """Appointments per department per day, from the rollups."""
+    rows = db.session.execute(
+        db.select(AppointmentRollup.day, AppointmentRollup.department_id, Department.name,
+                  func.sum(AppointmentRollup.appointments))
+        .outerjoin(Department, Department.id == AppointmentRollup.department_id)
+        .where(AppointmentRollup.day.between(date_from, date_to))
+        .group_by(AppointmentRollup.day, AppointmentRollup.department_id, Department.name)
+        .order_by(AppointmentRollup.day, Department.name)).all()
+    return [{'day': day.isoformat(), 'department_id': dept_id or None, 'department': name or 'Unassigned',
+             'appointments': int(n)} for day, dept_id, name, n in rows]
+
+
+def doctor_report(date_from, date_to):
+    """Per-doctor totals with completion and cancellation rates, from the rollups."""
+    completed = func.sum(db.case((AppointmentRollup.status == 'Completed', AppointmentRollup.appointments), else_=0))
+    cancelled = func.sum(db.case((AppointmentRollup.status == 'Cancelled', AppointmentRollup.appointments), else_=0))
+    rows = db.session.execute(
+        db.select(AppointmentRollup.doctor_id, User.full_name, func.sum(AppointmentRollup.appointments),
+                  completed, cancelled)
+        .join(Doctor, Doctor.id == AppointmentRollup.doctor_id)
+        .join(User, User.id == Doctor.user_id)
+        .where(AppointmentRollup.day.between(date_from, date_to))
+        .group_by(AppointmentRollup.doctor_id, User.full_name)
+        .order_by(User.full_name)).all()
+    return [{'doctor_id': doc_id, 'doctor': name, 'appointments': int(total), 'completed': int(done),
+             'cancelled': int(cancel),
+             'completion_rate': round(done / total, 4) if total else None,
+             'cancellation_rate': round(cancel / total, 4) if total else None}
+            for doc_id, name, total, done, cancel in rows]
+
+
+def treatment_report(date_from, date_to):
+    """Treatments recorded per day, from the rollups."""
+    rows = db.session.execute(
+        db.select(TreatmentRollup.day, func.sum(TreatmentRollup.treatments))
+        .where(TreatmentRollup.day.between(date_from, date_to))
+        .group_by(TreatmentRollup.day).order_by(TreatmentRollup.day)).all()
+    return [{'day': day.isoformat(), 'treatments': int(n)} for day, n in rows]
+
+
+# -------------------------
+# Exports
+# -------------------------
+EXPORT_COLUMNS = ['appointment_id', 'date', 'time', 'status', 'doctor_id', 'doctor', 'department',
+                  'patient_id', 'patient', 'treatment_id', 'diagnosis', 'prescription', 'notes',
+                  'treatment_created_at']
+
+
+def export_tier_stmt(appointment, treatment, date_from, date_to, department, watermark):
+    """Export rows from one storage tier (live or archive tables)."""
+    doctor_user = aliased(User)
+    patient_user = aliased(User)
+    stmt = (db.select(appointment.id.label('appointment_id'), appointment.date, appointment.time,
+                      appointment.status, appointment.doctor_id, doctor_user.full_name.label('doctor'),
+                      Department.name.label('department'), appointment.patient_id,
+                      patient_user.full_name.label('patient'), treatment.id.label('treatment_id'),
+                      treatment.diagnosis, treatment.prescription, treatment.notes,
+                      treatment.created_at.label('treatment_created_at'))
+            .join(Doctor, Doctor.id == appointment.doctor_id)
+            .join(doctor_user, doctor_user.id == Doctor.user_id)
+            .outerjoin(Department, Department.id == Doctor.department_id)
+            .join(Patient, Patient.id == appointment.patient_id)
+            .join(patient_user, patient_user.id == Patient.user_id)
+            .outerjoin(treatment, treatment.appointment_id == appointment.id))
+    if date_from:
+        stmt = stmt.where(appointment.date >= date_from)
+    if date_to:
+        stmt = stmt.where(appointment.date <= date_to)
+    if department:
+        stmt = stmt.where(func.lower(Department.name) == department.lower())
+    if watermark:
+        stmt = stmt.where(or_(appointment.id > watermark.last_appointment_id,
+                              treatment.id > watermark.last_treatment_id))
+    return stmt
+
+
+def export_stmt(date_from=None, date_to=None, department=None, watermark=None, include_archived=True):
+    """One query yielding an appointment row per treatment (or one row if untreated).
+
+    Archived appointments and treatments are included by default, so archival
+    never changes what an export of a date range contains. Archived rows keep
+    their original ids, so one ordering covers both tiers.
+
+    With a ``watermark``, only rows it has not delivered yet are selected: new
+    appointments, and new treatments on older appointments. Status changes on
+    already-exported appointments are not re-sent.
+    """
+    filters = (date_from, date_to, department, watermark)
+    stmt = export_tier_stmt(Appointment, Treatment, *filters)
+    if not include_archived:
+        return stmt.order_by(Appointment.id, Treatment.id)
+    both = db.union_all(stmt, export_tier_stmt(AppointmentArchive, TreatmentArchive, *filters)).subquery()
+    return db.select(both).order_by(both.c.appointment_id, both.c.treatment_id)
+
+
+def export_rows(stmt, watermark=None):
+    """Yield export rows as dicts, streaming from the cursor in EXPORT_BATCH chunks.
+
+    When the iteration finishes, ``watermark`` (if given) is advanced past
+    everything yielded and committed; an interrupted export leaves it untouched.
+    """
+    last_appt = watermark.last_appointment_id if watermark else 0
+    last_treat = watermark.last_treatment_id if watermark else 0
+    count = 0
+    for row in db.session.execute(stmt.execution_options(yield_per=current_app.config['EXPORT_BATCH'])):
+        count += 1
+        last_appt = max(last_appt, row.appointment_id)
+        last_treat = max(last_treat, row.treatment_id or 0)
+        yield row._asdict()
+    if watermark:
+        watermark.last_appointment_id = last_appt
+        watermark.last_treatment_id = last_treat
+        watermark.rows = count
+        watermark.exported_at = datetime.utcnow()
+        db.session.commit()
+
+
+def get_watermark(name):
+    watermark = ExportWatermark.query.filter_by(name=name).first()
+    if not watermark:
+        watermark = ExportWatermark(name=name, last_appointment_id=0, last_treatment_id=0, rows=0)
+        db.session.add(watermark)
+        db.session.flush()
+    return watermark
+
+
+def export_value(v):
+    return v.isoformat() if isinstance(v, (date, datetime)) else v
+
+
+def csv_chunks(rows, flush_every=500):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    for i, row in enumerate(rows, 1):
+        writer.writerow({k: export_value(v) for k, v in row.items()})
+        if i % flush_every == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def ndjson_chunks(rows):
+    for row in rows:
+        yield json.dumps({k: export_value(v) for k, v in row.items()}) + '\n'
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_filters(args):
+    """Parse ``date_from``/``date_to``/``department``/``include_archived`` from ``args``; raises ValueError."""
+    return {
+        'date_from': datetime.strptime(args['date_from'], '%Y-%m-%d').date() if args.get('date_from') else None,
+        'date_to': datetime.strptime(args['date_to'], '%Y-%m-%d').date() if args.get('date_to') else None,
+        'department': args.get('department') or None,
+        'include_archived': str(args.get('include_archived', '1')).lower() not in ('0', 'false'),
+    }
+
+
+# -------------------------
+# Bulk appointment import
+# -------------------------
+APPOINTMENT_STATUSES = ('Booked', 'Completed', 'Cancelled')
+SQL_IN_CHUNK = 500  # keep IN lists well under SQLite's bound-parameter limit
+
+
+def chunked(seq, size):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def dialect_insert(model):
+    """``INSERT`` construct for the bound dialect, supporting ``on_conflict_*``."""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
+
+
+def read_appointment_records(raw, content_type=''):
+    """Parse a JSON array (or ``{"appointments": [...]}``) or CSV text into dicts."""
+    if 'csv' in content_type:
+        return list(csv.DictReader(io.StringIO(raw)))
+    data = json.loads(raw)
+    if isinstance(data, dict):
+        data = data.get('appointments', [])
+    if not isinstance(data, list):
+        raise ValueError('expected a JSON array of appointments')
+    return data
+
+
+def bulk_import_appointments(records):
+    """Validate and insert appointment ``records`` in batched transactions.
+
+    Patient/doctor ids, doctor availability and live slot holds are checked up
+    front with a handful of set-based queries. Each batch is one ``INSERT ... ON CONFLICT DO
+    NOTHING RETURNING`` on ``uix_doctor_datetime``, so a taken slot is reported
+    as a conflict for that row instead of aborting the import. Returns a list
+    of per-row results ``{'row', 'status', 'id' | 'error'}``.
+    """
+    results = [None] * len(records)
+    parsed = []
+    for i, rec in enumerate(records):
+        try:
+            status = (rec.get('status') or 'Booked').strip()
+            if status not in APPOINTMENT_STATUSES:
+                raise ValueError(f'invalid status {status!r}')
+            parsed.append((i, {
+                'patient_id': int(rec['patient_id']),
+                'doctor_id': int(rec['doctor_id']),
+                'date': datetime.strptime(str(rec['date']).strip(), '%Y-%m-%d').date(),
+                'time': str(rec['time']).strip(),
+                'status': status,
+            }))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            results[i] = {'row': i, 'status': 'error', 'error': f'invalid row: {e}'}
+
+    patient_ids, doctor_ids = set(), set()
+    for chunk in chunked({r['patient_id'] for _, r in parsed}, SQL_IN_CHUNK):
+        patient_ids.update(db.session.execute(db.select(Patient.id).where(Patient.id.in_(chunk))).scalars())
+    for chunk in chunked({r['doctor_id'] for _, r in parsed}, SQL_IN_CHUNK):
+        doctor_ids.update(db.session.execute(
+            db.select(Doctor.id).join(User, User.id == Doctor.user_id)
+            .where(Doctor.id.in_(chunk), User.active.is_(True))).scalars())
+    holds = {}
+    if parsed:
+        first, last = min(r['date'] for _, r in parsed), max(r['date'] for _, r in parsed)
+        for chunk in chunked(doctor_ids, SQL_IN_CHUNK):
+            for doc_id, d, t, holder in db.session.execute(
+                    db.select(SlotHold.doctor_id, SlotHold.date, SlotHold.time, SlotHold.patient_id)
+                    .where(SlotHold.doctor_id.in_(chunk), SlotHold.date.between(first, last),
+                           SlotHold.expires_at > datetime.utcnow())):
+                holds[(doc_id, d, t)] = holder
+    pending, seen = [], set()
+    for i, r in parsed:
+        key = (r['doctor_id'], r['date'], r['time'])
+        if r['patient_id'] not in patient_ids:
+            results[i] = {'row': i, 'status': 'error', 'error': 'unknown patient'}
+        elif r['doctor_id'] not in doctor_ids:
+            results[i] = {'row': i, 'status': 'error', 'error': 'unknown or inactive doctor'}
+        elif not slot_offered(r['doctor_id'], r['date'], r['time']):
+            results[i] = {'row': i, 'status': 'error', 'error': 'time not in doctor availability'}
+        elif holds.get(key, r['patient_id']) != r['patient_id']:
+            results[i] = {'row': i, 'status': 'conflict', 'error': 'slot is held by another patient'}
+        elif key in seen:
+            results[i] = {'row': i, 'status': 'conflict', 'error': 'duplicate slot within import'}
+        else:
+            seen.add(key)
+            pending.append((i, r))
+
+    stmt = dialect_insert(Appointment).on_conflict_do_nothing(
+        index_elements=['doctor_id', 'date', 'time']
+    ).returning(Appointment.id, Appointment.doctor_id, Appointment.date, Appointment.time)
+    for batch in chunked(pending, current_app.config['BULK_BATCH_SIZE']):
+        created = {(doc_id, d, t): appt_id for appt_id, doc_id, d, t in
+                   db.session.execute(stmt, [r for _, r in batch])}
+        inserted = [r for _, r in batch if (r['doctor_id'], r['date'], r['time']) in created]
+        record_appointment_changes(db.session.connection(),
+                                   [(r['doctor_id'], r['date'], r['status'], 1) for r in inserted])
+        bump_entity_versions(db.session.connection(), {key for r in inserted for key in
+                                                       (('patient', r['patient_id']), ('doctor', r['doctor_id']))})
+        db.session.commit()
+        for i, r in batch:
+            appt_id = created.get((r['doctor_id'], r['date'], r['time']))
+            if appt_id:
+                results[i] = {'row': i, 'status': 'created', 'id': appt_id}
+            else:
+                results[i] = {'row': i, 'status': 'conflict', 'error': 'slot already taken'}
+    return results
+
+
+def summarize_import(results):
+    summary = {'created': 0, 'conflict': 0, 'error': 0}
+    for r in results:
+        summary[r['status']] += 1
+    return summary
+
+
+# -------------------------
+# Archival
+# -------------------------
+# Finished appointments past the horizon move, with their treatments, to the
+# *_archive tables in batched transactions. Core INSERT..SELECT/DELETE bypass the
+# ORM flush hook, so occupancy counters and rollups keep counting archived history.
+ARCHIVE_STATUSES = ('Completed', 'Cancelled')
+
+
+def archive_candidates_stmt(before):
+    # SQLite hands out max(rowid) + 1 for new rows, so the rows holding the current
+    # maximum appointment/treatment id stay put; otherwise a new row could reuse
+    # an id that already exists in the archive.
+    newest_treated = db.select(Treatment.appointment_id).where(
+        Treatment.id == db.select(func.max(Treatment.id)).scalar_subquery())
+    return (db.select(Appointment.id)
+            .where(Appointment.status.in_(ARCHIVE_STATUSES), Appointment.date < before,
+                   Appointment.id < db.select(func.max(Appointment.id)).scalar_subquery(),
+                   Appointment.id.not_in(newest_treated))
+            .order_by(Appointment.id))
+
+
+def archive_appointments(before, batch_size=None, dry_run=False):
+    """Move finished appointments dated before ``before`` into the archive tables.
+
+    Returns ``{'appointments': n, 'treatments': n, 'batches': n}``; with
+    ``dry_run`` only counts what would move.
+    """
+    batch_size = min(batch_size or current_app.config['ARCHIVE_BATCH_SIZE'], SQL_IN_CHUNK)
+    moved = {'appointments': 0, 'treatments': 0, 'batches': 0}
+    if dry_run:
+        ids = archive_candidates_stmt(before).subquery()
+        moved['appointments'] = db.session.execute(db.select(func.count()).select_from(ids)).scalar()
+        moved['treatments'] = db.session.execute(
+            db.select(func.count(Treatment.id)).where(Treatment.appointment_id.in_(db.select(ids.c.id)))).scalar()
+        return moved
+    appt_cols = [c.name for c in Appointment.__table__.c]
+    treat_cols = [c.name for c in Treatment.__table__.c]
+    while True:
+        ids = db.session.execute(archive_candidates_stmt(before).limit(batch_size)).scalars().all()
+        if not ids:
+            break
+        # history pages with and without the archive both change
+        bump_entity_versions(db.session.connection(), appointment_owners(db.session.connection(), ids))
+        now = db.literal(datetime.utcnow(), db.DateTime)
+        db.session.execute(db.insert(AppointmentArchive).from_select(
+            appt_cols + ['archived_at'],
+            db.select(*[Appointment.__table__.c[c] for c in appt_cols], now).where(Appointment.id.in_(ids))))
+        db.session.execute(db.insert(TreatmentArchive).from_select(
+            treat_cols, db.select(*[Treatment.__table__.c[c] for c in treat_cols])
+            .where(Treatment.appointment_id.in_(ids))))
+        moved['treatments'] += db.session.execute(
+            db.delete(Treatment).where(Treatment.appointment_id.in_(ids))).rowcount
+        moved['appointments'] += db.session.execute(
+            db.delete(Appointment).where(Appointment.id.in_(ids))).rowcount
+        moved['batches'] += 1
+        db.session.commit()
+    return moved
+
+
+def database_space():
+    """(file bytes, free-list bytes) of a SQLite database; (None, None) elsewhere."""
+    if db.engine.dialect.name != 'sqlite':
+        return None, None
+    with db.engine.connect() as conn:
+        page_size = conn.exec_driver_sql('PRAGMA page_size').scalar()
+        pages = conn.exec_driver_sql('PRAGMA page_count').scalar()
+        free = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+    return pages * page_size, free * page_size
+
+
+def vacuum_database():
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('VACUUM')
+
+
+def patient_appointments(patient_id, include_archived=False):
+    """A patient's appointments, newest first; archived ones only when asked for.
+
+    One query per tier: doctors and treatments are joined in, and the treatment
+    text columns stay deferred, so only previews travel with the page.
+    """
+    appointments = (Appointment.query
+                    .options(joinedload(Appointment.doctor).joinedload(Doctor.user),
+                             joinedload(Appointment.treatments))
+                    .filter_by(patient_id=patient_id)
+                    .order_by(Appointment.date.desc()).all())
+    if include_archived:
+        appointments += (AppointmentArchive.query
+                         .options(joinedload(AppointmentArchive.doctor).joinedload(Doctor.user),
+                                  joinedload(AppointmentArchive.treatments))
+                         .filter_by(patient_id=patient_id)
+                         .order_by(AppointmentArchive.date.desc()).all())
+        appointments.sort(key=lambda a: (a.date, a.time), reverse=True)
+    return appointments
+
+
+# -------------------------
+# Treatment text
+# -------------------------
+def compact_treatment_text(model=None, batch_size=None):
+    """Fill previews and compress large texts of existing ``model`` rows; returns rows rewritten.
+
+    Texts are read through CompressedText and written back through it, so rows
+    stored before compression existed are packed, and already-packed ones are
+    left as they are.
+    """
+    model = model or Treatment
+    batch_size = batch_size or current_app.config['BULK_BATCH_SIZE']
+    table = model.__table__
+    rewritten, last_id = 0, 0
+    while True:
+        rows = db.session.execute(
+            db.select(table.c.id, table.c.diagnosis, table.c.prescription, table.c.notes)
+            .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)).all()
+        if not rows:
+            break
+        db.session.execute(table.update().where(table.c.id == db.bindparam('row_id')), [
+            {'row_id': r.id, 'diagnosis': r.diagnosis, 'prescription': r.prescription, 'notes': r.notes,
+             'diagnosis_preview': text_preview(r.diagnosis), 'prescription_preview': text_preview(r.prescription)}
+            for r in rows])
+        db.session.commit()
+        rewritten += len(rows)
+        last_id = rows[-1].id
+    return rewritten
+
+
+def find_treatment(treatment_id):
+    """A treatment from the live table or, failing that, the archive."""
+    return (db.session.get(Treatment, treatment_id)
+            or db.session.get(TreatmentArchive, treatment_id))
+
+
+# -------------------------
+# Background jobs
+# -------------------------
+# Jobs live in the ``job`` table, so they survive restarts and any number of
+# worker processes can share the queue. Workers claim ready jobs with a single
+# UPDATE .. RETURNING, run them on a thread pool (jobs of one kind in batches of
+# the handler's batch_size) and retry failures with exponential backoff.
+JOB_HANDLERS = {}  # kind -> (fn(payloads) -> result, batch_size)
+# kind -> seconds between runs; workers queue these themselves, so they need no cron entry
+PERIODIC_JOBS = {'materialize_availability': 24 * 3600}
+
+
+def job_handler(kind, batch_size=1):
+    """Register ``fn(payloads)`` for ``kind``; it receives up to ``batch_size`` payloads per call."""
+    def register(fn):
+        JOB_HANDLERS[kind] = (fn, batch_size)
+        return fn
+    return register
+
+
+def enqueue_job(kind, payload=None, delay=0, max_attempts=None):
+    """Add a job to the session; workers see it once the caller commits."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f'unknown job kind {kind!r}')
+    now = datetime.utcnow()
+    job = Job(kind=kind, payload=json.dumps(payload or {}), status='queued', attempts=0,
+              max_attempts=max_attempts or current_app.config['JOB_MAX_ATTEMPTS'],
+              run_after=now + timedelta(seconds=delay), created_at=now)
+    db.session.add(job)
+    return job
+
+
+def claim_jobs(worker, limit):
+    """Mark up to ``limit`` ready jobs as running for ``worker`` and return them."""
+    now = datetime.utcnow()
+    ready = (db.select(Job.id).where(Job.status == 'queued', Job.run_after <= now)
+             .order_by(Job.id).limit(limit).with_for_update(skip_locked=True))
+    rows = db.session.execute(
+        db.update(Job).where(Job.id.in_(ready), Job.status == 'queued')
+        .values(status='running', worker=worker, started_at=now, attempts=Job.attempts + 1)
+        .returning(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts),
+        execution_options={'synchronize_session': False}).all()
+    db.session.commit()
+    return sorted(rows, key=lambda r: r.id)
+
+
+def requeue_stale_jobs():
+    """Put jobs whose worker vanished (running longer than JOB_TIMEOUT) back in the queue.
+
+    A job that has used up its attempts is failed instead, so one that keeps
+    crashing or hanging its worker stops being retried.
+    """
+    now = datetime.utcnow()
+    stale = and_(Job.status == 'running',
+                 Job.started_at < now - timedelta(seconds=current_app.config['JOB_TIMEOUT']))
+    db.session.execute(
+        db.update(Job).where(stale, Job.attempts >= Job.max_attempts)
+        .values(status='failed', finished_at=now, last_error='worker timed out'),
+        execution_options={'synchronize_session': False})
+    n = db.session.execute(
+        db.update(Job).where(stale)
+        .values(status='queued', run_after=now, last_error='worker timed out'),
+        execution_options={'synchronize_session': False}).rowcount
+    db.session.commit()
+    return n
+
+
+def retry_delay(attempts):
+    return min(current_app.config['JOB_BACKOFF_BASE'] * 2 ** (attempts - 1), current_app.config['JOB_BACKOFF_MAX'])
+
+
+def run_job_batch(app, kind, jobs):
+    """Run one handler call for ``jobs`` (claimed rows of one kind) and record the outcome."""
+    with app.app_context():
+        now = datetime.utcnow()
+        try:
+            if kind not in JOB_HANDLERS:
+                raise LookupError(f'no handler for job kind {kind!r}')
+            fn, _ = JOB_HANDLERS[kind]
+            result = fn([json.loads(j.payload or '{}') for j in jobs])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.exception('job %s %s failed', kind, [j.id for j in jobs])
+            error = f'{type(e).__name__}: {e}'[:2000]
+            for j in jobs:
+                if j.attempts >= j.max_attempts or kind not in JOB_HANDLERS:
+                    values = {'status': 'failed', 'finished_at': now}
+                else:
+                    values = {'status': 'queued', 'run_after': now + timedelta(seconds=retry_delay(j.attempts))}
+                db.session.execute(db.update(Job).where(Job.id == j.id).values(last_error=error, **values),
+                                   execution_options={'synchronize_session': False})
+        else:
+            db.session.execute(
+                db.update(Job).where(Job.id.in_([j.id for j in jobs]))
+                .values(status='done', finished_at=datetime.utcnow(), result=json.dumps(result)),
+                execution_options={'synchronize_session': False})
+        db.session.commit()
+
+
+def enqueue_periodic_jobs():
+    """Queue each PERIODIC_JOBS kind not queued, running or created within its interval."""
+    now = datetime.utcnow()
+    queued = []
+    for kind, interval in PERIODIC_JOBS.items():
+        if not db.session.execute(db.select(Job.id).where(
+                Job.kind == kind, or_(Job.status.in_(('queued', 'running')),
+                                      Job.created_at > now - timedelta(seconds=interval))).limit(1)).first():
+            enqueue_job(kind)
+            queued.append(kind)
+    db.session.commit()
+    return queued
+
+
+def run_worker(app, threads=None, once=False, worker=None):
+    """Claim and run jobs until interrupted; with ``once``, stop when nothing is ready.
+
+    Returns the number of jobs processed.
+    """
+    threads = threads or app.config['JOB_WORKER_THREADS']
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    processed = 0
+    periodic_checked = None
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='job') as pool:
+        while True:
+            with app.app_context():
+                if periodic_checked is None or time.monotonic() - periodic_checked >= app.config['JOB_PERIODIC_CHECK']:
+                    periodic_checked = time.monotonic()
+                    enqueue_periodic_jobs()
+                requeue_stale_jobs()
+                claimed = claim_jobs(worker, app.config['JOB_CLAIM_BATCH'])
+            if not claimed:
+                if once:
+                    return processed
+                time.sleep(app.config['JOB_POLL_INTERVAL'])
+                continue
+            by_kind = {}
+            for job in claimed:
+                by_kind.setdefault(job.kind, []).append(job)
+            futures = [pool.submit(run_job_batch, app, kind, batch)
+                       for kind, jobs in by_kind.items()
+                       for batch in chunked(jobs, JOB_HANDLERS.get(kind, (None, 1))[1])]
+            for future in futures:
+                future.result()
+            processed += len(claimed)
+
+
+def job_stats(recent=200):
+    """Queue depth per status and kind, plus wait/run latency over the most recent finished jobs."""
+    depth = {}
+    for status, kind, n in db.session.execute(
+            db.select(Job.status, Job.kind, func.count(Job.id)).group_by(Job.status, Job.kind)):
+        depth.setdefault(status, {})[kind] = n
+    oldest = db.session.execute(db.select(func.min(Job.run_after)).where(Job.status == 'queued')).scalar()
+    finished = db.session.execute(
+        db.select(Job.created_at, Job.started_at, Job.finished_at).where(Job.status == 'done')
+        .order_by(Job.finished_at.desc()).limit(recent)).all()
+
+    def summary(values):
+        values = sorted(values)
+        if not values:
+            return {'mean_s': None, 'p95_s': None}
+        return {'mean_s': round(sum(values) / len(values), 3),
+                'p95_s': round(values[min(len(values) - 1, int(0.95 * len(values)))], 3)}
+    return {
+        'depth': depth,
+        'queued': sum(depth.get('queued', {}).values()),
+        'oldest_queued_s': round((datetime.utcnow() - oldest).total_seconds(), 1) if oldest else None,
+        'wait': summary([(r.started_at - r.created_at).total_seconds() for r in finished]),
+        'run': summary([(r.finished_at - r.started_at).total_seconds() for r in finished]),
+        'sampled': len(finished),
+    }
+
+
+def export_dir():
+    path = current_app.config['EXPORT_DIR'] or os.path.join(current_app.instance_path, 'exports')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@job_handler('appointment_reminders', batch_size=10)
+def send_appointment_reminders(payloads):
+    """Queue a reminder for every booked appointment on the requested days (once per appointment)."""
+    lead = timedelta(days=current_app.config['REMINDER_LEAD_DAYS'])
+    days = {datetime.strptime(p['date'], '%Y-%m-%d').date() if p.get('date') else date.today() + lead
+            for p in payloads}
+    doctor_user = aliased(User)
+    rows = db.session.execute(
+        db.select(Appointment.id, Patient.user_id, Appointment.date, Appointment.time, doctor_user.full_name)
+        .join(Patient, Patient.id == Appointment.patient_id)
+        .join(Doctor, Doctor.id == Appointment.doctor_id)
+        .join(doctor_user, doctor_user.id == Doctor.user_id)
+        .where(Appointment.date.in_(days), or_(Appointment.status == 'Booked', Appointment.status.is_(None)))).all()
+    stmt = dialect_insert(Notification).on_conflict_do_nothing(index_elements=['appointment_id', 'kind'])
+    sent = 0
+    now = datetime.utcnow()
+    for batch in chunked(rows, current_app.config['BULK_BATCH_SIZE']):
+        sent += len(db.session.execute(stmt.returning(Notification.id), [
+            {'user_id': user_id, 'appointment_id': appt_id, 'kind': 'reminder', 'created_at': now,
+             'message': f'Reminder: appointment with {doctor} on {d.isoformat()} at {t}'}
+            for appt_id, user_id, d, t, doctor in batch]).all())
+    return {'days': sorted(d.isoformat() for d in days), 'appointments': len(rows), 'reminders': sent}
+
+
+@job_handler('doctor_availability', batch_size=50)
+def doctor_availability_changed(payloads):
+    """Follow-up after doctors are (de)activated.
+
+    Slot holds on their calendars are dropped, and when a doctor is now inactive
+    every patient with an upcoming booking gets a notification.
+    """
+    doctor_ids = {p['doctor_id'] for p in payloads}
+    inactive = set(db.session.execute(
+        db.select(Doctor.id).join(User, User.id == Doctor.user_id)
+        .where(Doctor.id.in_(doctor_ids), User.active.is_(False))).scalars())
+    db.session.execute(db.delete(SlotHold).where(SlotHold.doctor_id.in_(doctor_ids)))
+    notified = 0
+    if inactive:
+        rows = db.session.execute(
+            db.select(Appointment.id, Patient.user_id, Appointment.date, Appointment.time)
+            .join(Patient, Patient.id == Appointment.patient_id)
+            .where(Appointment.doctor_id.in_(inactive), Appointment.date >= date.today(),
+                   or_(Appointment.status == 'Booked', Appointment.status.is_(None)))).all()
+        if rows:
+            stmt = dialect_insert(Notification).on_conflict_do_nothing(index_elements=['appointment_id', 'kind'])
+            notified = len(db.session.execute(stmt.returning(Notification.id), [
+                {'user_id': user_id, 'appointment_id': appt_id, 'kind': 'doctor_unavailable',
+                 'created_at': datetime.utcnow(),
+                 'message': f'Your doctor for {d.isoformat()} {t} is no longer available; please rebook.'}
+                for appt_id, user_id, d, t in rows]).all())
+    return {'doctors': sorted(doctor_ids), 'inactive': sorted(inactive), 'notified': notified}
+
+
+@job_handler('export_appointments')
+def export_appointments_job(payloads):
+    """Write an export file into export_dir(); the job result names it."""
+    (payload,) = payloads
+    fmt = payload.get('format', 'csv')
+    watermark = get_watermark(payload['watermark']) if payload.get('watermark') else None
+    count = [0]
+
+    def counted(rows):
+        for row in rows:
+            count[0] += 1
+            yield row
+    rows = counted(export_rows(export_stmt(watermark=watermark, **export_filters(payload)), watermark))
+    chunks = csv_chunks(rows) if fmt == 'csv' else ndjson_chunks(rows)
+    path = os.path.join(export_dir(), payload['filename'])
+    if payload.get('gzip'):
+        with open(path, 'wb') as fh:
+            for chunk in gzip_chunks(chunks):
+                fh.write(chunk)
+    else:
+        with open(path, 'w', encoding='utf-8', newline='') as fh:
+            for chunk in chunks:
+                fh.write(chunk)
+    return {'file': payload['filename'], 'rows': count[0], 'bytes': os.path.getsize(path)}
+
+
+# Maintenance jobs. Several queued copies run as one call, so repeated requests coalesce.
+@job_handler('rebuild_rollups', batch_size=100)
+def rebuild_rollups_job(payloads):
+    rebuild_rollups()
+    return {'coalesced': len(payloads)}
+
+
+@job_handler('rebuild_occupancy', batch_size=100)
+def rebuild_occupancy_job(payloads):
+    rebuild_occupancy()
+    return {'coalesced': len(payloads)}
+
+
+@job_handler('archive_appointments')
+def archive_appointments_job(payloads):
+    horizon = payloads[0].get('horizon_days', current_app.config['ARCHIVE_HORIZON_DAYS'])
+    return archive_appointments(date.today() - timedelta(days=horizon))
+
+
+@job_handler('sweep_holds', batch_size=100)
+def sweep_holds_job(payloads):
+    return {'removed': sweep_expired_holds()}
+
+
+@job_handler('materialize_availability', batch_size=100)
+def materialize_availability_job(payloads):
+    """Roll the materialized slot horizon forward (daily) or resync the listed doctors."""
+    doctor_ids = None
+    if all(p.get('doctor_ids') for p in payloads):
+        doctor_ids = sorted({d for p in payloads for d in p['doctor_ids']})
+    inserted, deleted = materialize_availability(doctor_ids)
+    return {'inserted': inserted, 'deleted': deleted}
+
+
+# kinds an admin may start from the jobs page
+ADMIN_JOB_KINDS = ('appointment_reminders', 'rebuild_rollups', 'rebuild_occupancy', 'archive_appointments',
+                   'sweep_holds', 'materialize_availability')
+
+
 # -------------------------
 # Routes - Auth
 # -------------------------
 
 
-@app.route('/')
+@bp.route('/')
 def home():
     if current_user.is_authenticated:
         if current_user.role == 'admin':
-            return redirect(url_for('admin_dashboard'))
+            return redirect(url_for('.admin_dashboard'))
         if current_user.role == 'doctor':
-            return redirect(url_for('doctor_dashboard'))
+            return redirect(url_for('.doctor_dashboard'))
         if current_user.role == 'patient':
-            return redirect(url_for('patient_dashboard'))
-    return redirect(url_for('login'))
+            return redirect(url_for('.patient_dashboard'))
+    return redirect(url_for('.login'))
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     if request.method == 'POST':
         username = request.form['username'].strip()
         password = request.form['password']
+        # throttle before doing any hashing so brute-force attempts cost us nothing
+        if not login_ip_limiter.allow(request.remote_addr or '') or not login_user_limiter.allow(username.lower()):
+            flash('Too many login attempts. Please wait a moment and try again.', 'danger')
+            return render_template('login.html'), 429
         user = User.query.filter_by(username=username).first()
-        if user and user.check_password(password) and user.active:
+        try:
+            valid = bool(user and user.active and user.check_password(password))
+        except VerifierBusy:
+            flash('The server is busy. Please try again.', 'danger')
+            return render_template('login.html'), 503
+        if valid:
+            if user.password_needs_rehash():
+                user.set_password(password)
+                db.session.commit()
+                invalidate_user_cache(user.id)
             login_user(user)
             flash('Logged in', 'success')
-            return redirect(url_for('home'))
+            return redirect(url_for('.home'))
         flash('Invalid credentials or account inactive', 'danger')
     return render_template('login.html')
 
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('login'))
+    return redirect(url_for('.login'))
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     if request.method == 'POST':
         username = request.form['username'].strip()
         password = request.form['password']
         full_name = request.form.get('full_name', '').strip()
         if User.query.filter_by(username=username).first():
             flash('Username already exists', 'danger')
-            return redirect(url_for('register'))
+            return redirect(url_for('.register'))
         user = User(username=username, role='patient', full_name=full_name)
         user.set_password(password)
         db.session.add(user)
@@ -178,37 +2659,52 @@ def register():
         patient = Patient(user_id=user.id)
         db.session.add(patient)
         db.session.commit()
+        invalidate_user_cache(user.id)
         flash('Registered. Please log in.', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     return render_template('register.html')
 
 
 # -------------------------
 # Admin routes
 # -------------------------
-@app.route('/admin')
+@bp.route('/admin')
 @login_required
 def admin_dashboard():
     if current_user.role != 'admin':
         flash('Unauthorized', 'danger')
-        return redirect(url_for('home'))
-    total_doctors = Doctor.query.count()
-    total_patients = Patient.query.count()
-    total_appointments = Appointment.query.count()
-    doctors = Doctor.query.all()
-    patients = Patient.query.all()
-    appointments = Appointment.query.order_by(Appointment.date.desc()).all()
-    return render_template('admin_dashboard.html', doctors=doctors, patients=patients,
-                           appointments=appointments, total_doctors=total_doctors,
-                           total_patients=total_patients, total_appointments=total_appointments)
-
-
-@app.route('/admin/create_doctor', methods=['GET', 'POST'])
+        return redirect(url_for('.home'))
+    stats = dashboard_stats()
+    doctors = (Doctor.query.options(joinedload(Doctor.user)).order_by(Doctor.id.desc())
+               .limit(current_app.config['ADMIN_DOCTOR_LIST']).all())
+    # keyset pagination over (date desc, id desc); the cursor is the last row of the previous page
+    page_size = current_app.config['ADMIN_PAGE_SIZE']
+    query = Appointment.query.options(
+        joinedload(Appointment.doctor).joinedload(Doctor.user),
+        joinedload(Appointment.patient).joinedload(Patient.user),
+    )
+    cursor = decode_cursor(request.args.get('cursor'))
+    if cursor:
+        cur_date, cur_id = cursor
+        query = query.filter(or_(Appointment.date < cur_date,
+                                 and_(Appointment.date == cur_date, Appointment.id < cur_id)))
+    appointments = query.order_by(Appointment.date.desc(), Appointment.id.desc()).limit(page_size + 1).all()
+    next_cursor = None
+    if len(appointments) > page_size:
+        appointments = appointments[:page_size]
+        next_cursor = encode_cursor(appointments[-1].date, appointments[-1].id)
+    return render_template('admin_dashboard.html', doctors=doctors, appointments=appointments,
+                           stats=stats, total_doctors=stats['doctors'],
+                           total_patients=stats['patients'], total_appointments=stats['appointments'],
+                           next_cursor=next_cursor, cursor=request.args.get('cursor'))
+
+
+@bp.route('/admin/create_doctor', methods=['GET', 'POST'])
 @login_required
 def create_doctor():
     if current_user.role != 'admin':
         flash('Unauthorized', 'danger')
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     departments = Department.query.all()
     if request.method == 'POST':
         username = request.form['username'].strip()
@@ -218,115 +2714,311 @@ def create_doctor():
         dept_id = request.form.get('department_id')
         if User.query.filter_by(username=username).first():
             flash('Username exists', 'danger')
-            return redirect(url_for('create_doctor'))
+            return redirect(url_for('.create_doctor'))
         user = User(username=username, role='doctor', full_name=full_name)
         user.set_password(password)
         db.session.add(user)
         db.session.commit()
-        doc = Doctor(user_id=user.id, specialization=specialization, availability_json=json.dumps({}),
+        doc = Doctor(user_id=user.id, specialization=specialization,
                      department_id=int(dept_id) if dept_id else None)
         db.session.add(doc)
+        doctor_directory.invalidate()
         db.session.commit()
+        invalidate_user_cache(user.id)
         flash('Doctor created', 'success')
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('.admin_dashboard'))
     return render_template('create_doctor.html', departments=departments)
 
 
-@app.route('/admin/toggle_active/<int:user_id>', methods=['POST'])
+@bp.route('/admin/toggle_active/<int:user_id>', methods=['POST'])
 @login_required
 def admin_toggle_active(user_id):
     if current_user.role != 'admin':
         flash('Unauthorized', 'danger')
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     user = User.query.get_or_404(user_id)
     user.active = not bool(user.active)
+    if user.role == 'doctor':
+        doctor_directory.invalidate()
+        doctor = Doctor.query.filter_by(user_id=user.id).first()
+        if doctor:
+            # clearing holds and notifying patients happens in the background
+            enqueue_job('doctor_availability', {'doctor_id': doctor.id})
     db.session.commit()
+    invalidate_user_cache(user.id)
     flash(f'User {user.username} {"activated" if user.active else "blacklisted"}', 'success')
-    return redirect(request.referrer or url_for('admin_dashboard'))
+    return redirect(request.referrer or url_for('.admin_dashboard'))
 
 
-@app.route('/admin/search', methods=['GET'])
+@bp.route('/admin/cache')
+@login_required
+def admin_cache_stats():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify({'profile_cache': profile_cache.stats(), 'page_cache': page_cache.stats(),
+                    'schedule_cache': schedule_cache.stats()})
+
+
+@bp.route('/admin/reports')
+@login_required
+def admin_reports():
+    if current_user.role != 'admin':
+        flash('Unauthorized', 'danger')
+        return redirect(url_for('.home'))
+    try:
+        date_from, date_to = report_range(request.args)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('.admin_reports'))
+    departments = department_report(date_from, date_to)
+    dept_totals = {}
+    for row in departments:
+        dept_totals[row['department']] = dept_totals.get(row['department'], 0) + row['appointments']
+    return render_template('admin_reports.html', date_from=date_from, date_to=date_to,
+                           departments=departments, dept_totals=dept_totals,
+                           doctors=doctor_report(date_from, date_to), treatments=treatment_report(date_from, date_to))
+
+
+@bp.route('/api/reports/<name>', methods=['GET'])
+@login_required
+def api_reports(name):
+    """``departments``, ``doctors`` or ``treatments`` report for ``?date_from=&date_to=``."""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    reports = {'departments': department_report, 'doctors': doctor_report, 'treatments': treatment_report}
+    if name not in reports:
+        return jsonify({'error': f'unknown report {name!r}'}), 404
+    try:
+        date_from, date_to = report_range(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'date_from': date_from.isoformat(), 'date_to': date_to.isoformat(),
+                    name: reports[name](date_from, date_to)})
+
+
+@bp.route('/admin/export')
+@login_required
+def admin_export():
+    """Stream appointments joined with treatments as CSV or NDJSON.
+
+    Query args: ``format`` (csv|ndjson), ``date_from``, ``date_to``, ``department``,
+    ``gzip=1``, ``watermark=<name>`` for an incremental export, ``include_archived=0``
+    to skip archived appointments and ``async=1`` to write the file from a
+    background job instead.
+    """
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    try:
+        filters = export_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    use_gzip = request.args.get('gzip') in ('1', 'true')
+    if request.args.get('async') in ('1', 'true'):
+        filename = f"appointments-{datetime.utcnow():%Y%m%d-%H%M%S}-{os.urandom(4).hex()}.{fmt}" + \
+            ('.gz' if use_gzip else '')
+        enqueue_job('export_appointments', {
+            'format': fmt, 'gzip': use_gzip, 'filename': filename, 'watermark': request.args.get('watermark'),
+            'date_from': request.args.get('date_from'), 'date_to': request.args.get('date_to'),
+            'department': request.args.get('department'),
+            'include_archived': request.args.get('include_archived', '1')})
+        db.session.commit()
+        flash('Export queued; it will be listed here when ready', 'success')
+        return redirect(url_for('.admin_jobs'))
+    watermark = get_watermark(request.args['watermark']) if request.args.get('watermark') else None
+    rows = export_rows(export_stmt(watermark=watermark, **filters), watermark)
+    chunks = csv_chunks(rows) if fmt == 'csv' else ndjson_chunks(rows)
+    filename = f"appointments-{date.today().isoformat()}.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    if use_gzip:
+        chunks, filename, mimetype = gzip_chunks(chunks), filename + '.gz', 'application/gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+@bp.route('/admin/jobs', methods=['GET', 'POST'])
+@login_required
+def admin_jobs():
+    """Queue depth and latency; POST ``kind`` (and ``date`` for reminders) to enqueue maintenance work."""
+    if current_user.role != 'admin':
+        flash('Unauthorized', 'danger')
+        return redirect(url_for('.home'))
+    if request.method == 'POST':
+        kind = request.form.get('kind')
+        if kind not in ADMIN_JOB_KINDS:
+            flash('Unknown job', 'danger')
+        else:
+            payload = {'date': request.form['date']} if kind == 'appointment_reminders' and request.form.get('date') \
+                else {}
+            enqueue_job(kind, payload)
+            db.session.commit()
+            flash(f'{kind} queued', 'success')
+        return redirect(url_for('.admin_jobs'))
+    recent = Job.query.order_by(Job.id.desc()).limit(25).all()
+    return render_template('admin_jobs.html', stats=job_stats(), jobs=recent, kinds=ADMIN_JOB_KINDS,
+                           results={j.id: json.loads(j.result) for j in recent if j.result})
+
+
+@bp.route('/admin/jobs/<int:job_id>/download')
+@login_required
+def admin_job_download(job_id):
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    job = Job.query.get_or_404(job_id)
+    if job.kind != 'export_appointments' or job.status != 'done':
+        abort(404)
+    return send_from_directory(export_dir(), json.loads(job.result)['file'], as_attachment=True)
+
+
+@bp.route('/admin/metrics')
+@login_required
+def admin_metrics():
+    if current_user.role != 'admin':
+        flash('Unauthorized', 'danger')
+        return redirect(url_for('.home'))
+    return render_template('admin_metrics.html', enabled=current_app.config['SQL_PROFILING'],
+                           endpoints=profiler.snapshot(), cache=profile_cache.stats(),
+                           buckets=[str(b) for b in LATENCY_BUCKETS_MS] + ['+Inf'],
+                           window=current_app.config['PROFILING_WINDOW'])
+
+
+@bp.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: bearer METRICS_TOKEN when configured, otherwise an admin session."""
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+    elif not (current_user.is_authenticated and current_user.role == 'admin'):
+        abort(401)
+    return Response(profiler.prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@bp.route('/admin/search', methods=['GET'])
 @login_required
 def admin_search():
     if current_user.role != 'admin':
         flash('Unauthorized', 'danger')
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     q = request.args.get('q', '').strip()
     type_ = request.args.get('type', 'patient')  # 'patient' or 'doctor'
-    results = []
+    page = request.args.get('page', 1, type=int)
+    has_next = False
     if type_ == 'patient':
-        query = Patient.query.join(User)
-        if q:
-            if q.isdigit():
-                query = query.filter(Patient.id == int(q))
-            else:
-                query = query.filter(User.full_name.ilike(f'%{q}%') | User.username.ilike(f'%{q}%') | User.contact.ilike(f'%{q}%'))
-        results = query.all()
+        if q.isdigit():
+            results = Patient.query.options(joinedload(Patient.user)).filter(Patient.id == int(q)).all()
+        else:
+            results, has_next = search_directory('patient', [(q, ['full_name', 'username', 'contact'])], page)
     else:
-        query = Doctor.query.join(User)
-        if q:
-            query = query.filter(User.full_name.ilike(f'%{q}%') | User.username.ilike(f'%{q}%') | Doctor.specialization.ilike(f'%{q}%'))
-        results = query.all()
-    return render_template('admin_search.html', results=results, q=q, type_=type_)
+        results, has_next = search_directory(
+            'doctor', [(q, ['full_name', 'username', 'specialization', 'department'])], page)
+    return render_template('admin_search.html', results=results, q=q, type_=type_, page=page, has_next=has_next)
 
 
 # -------------------------
 # Doctor routes
 # -------------------------
-@app.route('/doctor')
+@bp.route('/doctor')
 @login_required
 def doctor_dashboard():
     if current_user.role != 'doctor':
         flash('Unauthorized', 'danger')
-        return redirect(url_for('home'))
-    doc = Doctor.query.filter_by(user_id=current_user.id).first()
+        return redirect(url_for('.home'))
+    doc = current_doctor()
     today = date.today()
-    upcoming = Appointment.query.filter_by(doctor_id=doc.id).filter(Appointment.date >= today).order_by(Appointment.date).all()
-    # show assigned patients
-    assigned_patients = {a.patient.user.full_name: a.patient for a in upcoming}
-    return render_template('doctor_dashboard.html', doc=doc, upcoming=upcoming, patients=assigned_patients)
+    days = current_app.config['DOCTOR_DASHBOARD_DAYS']
+    token, _ = version_state([('doctor', doc.id)])
+    etag = make_etag('doctor_dashboard', current_user.id, token, today, days)
 
+    def render():
+        upcoming = doctor_window(doc.id, today, today + timedelta(days=days - 1))
+        # show assigned patients
+        assigned_patients = {a.patient.user.full_name: a.patient for a in upcoming}
+        return render_template('doctor_dashboard.html', doc=doc, upcoming=upcoming, patients=assigned_patients,
+                               days=days)
+    return conditional_page(etag, render)
 
-@app.route('/doctor/availability', methods=['GET', 'POST'])
+
+@bp.route('/doctor/schedule')
+@login_required
+def doctor_schedule():
+    if current_user.role != 'doctor':
+        flash('Unauthorized', 'danger')
+        return redirect(url_for('.home'))
+    doc = current_doctor()
+    try:
+        start, end, view = parse_schedule_window(request.args)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('.doctor_schedule'))
+    span = (end - start).days + 1
+    return render_template('doctor_schedule.html', appointments=doctor_window(doc.id, start, end),
+                           days=occupancy_days(doc.id, start, end), start=start, end=end, view=view,
+                           prev_start=start - timedelta(days=span), prev_end=start - timedelta(days=1),
+                           next_start=end + timedelta(days=1), next_end=end + timedelta(days=span))
+
+
+@bp.route('/doctor/availability', methods=['GET', 'POST'])
 @login_required
 def doctor_availability():
     if current_user.role != 'doctor':
         flash('Unauthorized', 'danger')
-        return redirect(url_for('home'))
-    doc = Doctor.query.filter_by(user_id=current_user.id).first()
-    availability = {}
-    if doc and doc.availability_json:
-        try:
-            availability = json.loads(doc.availability_json)
-        except:
-            availability = {}
-    dates = next_n_dates(7)
+        return redirect(url_for('.home'))
+    doc = current_doctor()
     if request.method == 'POST':
-        updated = {}
-        for d in dates:
-            key = f"slots-{d.isoformat()}"
-            val = request.form.get(key, '').strip()
-            slots = [t.strip() for t in val.split(',') if t.strip()]
-            if slots:
-                updated[d.isoformat()] = slots
-        doc.availability_json = json.dumps(updated)
-        db.session.commit()
+        action = request.form.get('action')
+        try:
+            if action == 'add_rule':
+                db.session.add(AvailabilityRule(doctor_id=doc.id, **rule_from_form(request.form)))
+            elif action == 'delete_rule':
+                db.session.execute(db.delete(AvailabilityRule).filter_by(
+                    id=int(request.form['rule_id']), doctor_id=doc.id))
+            elif action == 'add_exception':
+                kind = request.form.get('kind')
+                exc_time = request.form.get('time', '').strip() or None
+                if kind not in ('add', 'remove') or (kind == 'add' and not exc_time):
+                    raise ValueError('an added slot needs a time')
+                if exc_time:
+                    parse_clock(exc_time)
+                db.session.add(AvailabilityException(
+                    doctor_id=doc.id, date=datetime.strptime(request.form['date'], '%Y-%m-%d').date(),
+                    time=exc_time, kind=kind))
+            elif action == 'delete_exception':
+                db.session.execute(db.delete(AvailabilityException).filter_by(
+                    id=int(request.form['exception_id']), doctor_id=doc.id))
+            else:
+                raise ValueError('unknown action')
+        except (KeyError, ValueError) as e:
+            db.session.rollback()
+            flash(f'Invalid availability: {e}', 'danger')
+            return redirect(url_for('.doctor_availability'))
+        invalidate_schedule(doc.id)
+        materialize_availability([doc.id])
         flash('Availability updated', 'success')
-        return redirect(url_for('doctor_dashboard'))
-    return render_template('doctor_availability.html', availability=availability, dates=dates)
-
-
-@app.route('/doctor/appointment/<int:appt_id>/treat', methods=['GET', 'POST'])
+        return redirect(url_for('.doctor_availability'))
+    rules = AvailabilityRule.query.filter_by(doctor_id=doc.id).order_by(
+        AvailabilityRule.weekday, AvailabilityRule.start_time).all()
+    exceptions = AvailabilityException.query.filter(
+        AvailabilityException.doctor_id == doc.id, AvailabilityException.date >= date.today()).order_by(
+        AvailabilityException.date, AvailabilityException.time).all()
+    dates = next_n_dates(14)
+    return render_template('doctor_availability.html', rules=rules, exceptions=exceptions, weekdays=WEEKDAYS,
+                           availability=doctor_slots(doc.id, dates), dates=dates)
+
+
+@bp.route('/doctor/appointment/<int:appt_id>/treat', methods=['GET', 'POST'])
 @login_required
 def treat_appointment(appt_id):
     if current_user.role != 'doctor':
         flash('Unauthorized', 'danger')
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     appt = Appointment.query.get_or_404(appt_id)
-    doc = Doctor.query.filter_by(user_id=current_user.id).first()
+    doc = current_doctor()
     if appt.doctor_id != doc.id:
         flash('Unauthorized', 'danger')
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('.doctor_dashboard'))
     if request.method == 'POST':
         diagnosis = request.form.get('diagnosis', '').strip()
         prescription = request.form.get('prescription', '').strip()
@@ -336,184 +3028,513 @@ def treat_appointment(appt_id):
         db.session.add(t)
         db.session.commit()
         flash('Treatment saved and appointment marked Completed', 'success')
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('.doctor_dashboard'))
     return render_template('treat_appointment.html', appt=appt)
 
 
-@app.route('/doctor/appointment/<int:appt_id>/status', methods=['POST'])
+@bp.route('/doctor/appointment/<int:appt_id>/status', methods=['POST'])
 @login_required
 def doctor_update_status(appt_id):
     if current_user.role != 'doctor':
         flash('Unauthorized', 'danger')
-        return redirect(url_for('home'))
+        return redirect(url_for('.home'))
     appt = Appointment.query.get_or_404(appt_id)
-    doc = Doctor.query.filter_by(user_id=current_user.id).first()
+    doc = current_doctor()
     if appt.doctor_id != doc.id:
         flash('Unauthorized', 'danger')
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('.doctor_dashboard'))
     new_status = request.form.get('status')
     if new_status in ['Booked', 'Completed', 'Cancelled']:
         appt.status = new_status
         db.session.commit()
         flash('Status updated', 'success')
-    return redirect(request.referrer or url_for('doctor_dashboard'))
+    return redirect(request.referrer or url_for('.doctor_dashboard'))
 
 
 # -------------------------
 # Patient routes
 # -------------------------
-@app.route('/patient')
+@bp.route('/patient')
 @login_required
 def patient_dashboard():
     if current_user.role != 'patient':
         flash('Unauthorized', 'danger')
-        return redirect(url_for('home'))
-    patient = Patient.query.filter_by(user_id=current_user.id).first()
-    doctors = Doctor.query.all()
-    appointments = Appointment.query.filter_by(patient_id=patient.id).order_by(Appointment.date.desc()).all()
-    return render_template('patient_dashboard.html', patient=patient, doctors=doctors, appointments=appointments)
-
-
-@app.route('/doctor/<int:doctor_id>', methods=['GET', 'POST'])
+        return redirect(url_for('.home'))
+    patient = current_patient()
+    directory = doctor_directory.get()
+    token, _ = version_state([('patient', patient.id)])
+    etag = make_etag('patient_dashboard', current_user.id, token, directory.etag)
+
+    def render():
+        doctor_cards = directory.rendered('cards', lambda: Markup(
+            render_template('_doctor_cards.html', doctors=directory.doctors)))
+        appointments = (Appointment.query.options(joinedload(Appointment.doctor).joinedload(Doctor.user))
+                        .filter_by(patient_id=patient.id).order_by(Appointment.date.desc()).all())
+        return render_template('patient_dashboard.html', patient=patient, doctor_cards=doctor_cards,
+                               appointments=appointments)
+    return conditional_page(etag, render)
+
+
+@bp.route('/doctor/<int:doctor_id>', methods=['GET', 'POST'])
 @login_required
 def doctor_profile(doctor_id):
     # Used by patients to view a doctor's profile and book
     doc = Doctor.query.get_or_404(doctor_id)
-    availability = {}
-    if doc.availability_json:
-        try:
-            availability = json.loads(doc.availability_json)
-        except:
-            availability = {}
     if request.method == 'POST':
         if current_user.role != 'patient':
             flash('Only patients can book', 'danger')
-            return redirect(url_for('home'))
-        patient = Patient.query.filter_by(user_id=current_user.id).first()
+            return redirect(url_for('.home'))
+        patient = current_patient()
         date_str = request.form.get('date')
         time_str = request.form.get('time')
         try:
             appt_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         except:
             flash('Invalid date', 'danger')
-            return redirect(request.referrer or url_for('doctor_profile', doctor_id=doctor_id))
+            return redirect(request.referrer or url_for('.doctor_profile', doctor_id=doctor_id))
+        try:
+            parse_clock(time_str)
+        except ValueError:
+            flash('Select a time', 'danger')
+            return redirect(url_for('.doctor_profile', doctor_id=doctor_id))
         # check doctor active
         if not doc.user.active:
             flash('Doctor is not available', 'danger')
-            return redirect(url_for('patient_dashboard'))
-        # ensure time exists in availability if availability is provided for that date
-        if availability.get(date_str):
-            if time_str not in availability.get(date_str):
-                flash('Selected time not available for this doctor', 'danger')
-                return redirect(url_for('doctor_profile', doctor_id=doctor_id))
+            return redirect(url_for('.patient_dashboard'))
+        # ensure the doctor's schedule offers that time
+        if not slot_offered(doc.id, appt_date, time_str):
+            flash('Selected time not available for this doctor', 'danger')
+            return redirect(url_for('.doctor_profile', doctor_id=doctor_id))
+        # another patient's live hold turns us away with a read; the unique
+        # constraint settles races between two inserts
+        holder = active_hold(doc.id, appt_date, time_str)
+        if holder and holder.patient_id != patient.id:
+            flash('Someone else is booking that slot right now. Choose another time.', 'warning')
+            return redirect(url_for('.doctor_profile', doctor_id=doctor_id))
         # create appointment and handle unique constraint
         from sqlalchemy.exc import IntegrityError
         appt = Appointment(patient_id=patient.id, doctor_id=doc.id, date=appt_date, time=time_str)
         db.session.add(appt)
+        if holder:
+            release_hold(doc.id, appt_date, time_str, patient.id)
         try:
             db.session.commit()
             flash('Appointment booked', 'success')
-            return redirect(url_for('patient_dashboard'))
+            return redirect(url_for('.patient_dashboard'))
         except IntegrityError:
             db.session.rollback()
+            if holder:
+                # the rollback undid the release; the hold is useless now that the slot is taken
+                release_hold(doc.id, appt_date, time_str, patient.id)
+                db.session.commit()
             flash('Selected slot already taken. Choose another time.', 'danger')
-            return redirect(url_for('doctor_profile', doctor_id=doctor_id))
-    return render_template('doctor_profile.html', doctor=doc, availability=availability, next7=next_n_dates(7))
+            return redirect(url_for('.doctor_profile', doctor_id=doctor_id))
+    dates = next_n_dates(current_app.config['BOOKING_WINDOW_DAYS'])
+    availability = bookable_slots(doc.id, dates, current_patient().id) if current_user.role == 'patient' \
+        else doctor_slots(doc.id, dates)
+    return render_template('doctor_profile.html', doctor=doc, availability=availability, next7=dates)
 
 
-@app.route('/appointment/<int:appt_id>/cancel', methods=['POST'])
+@bp.route('/doctor/<int:doctor_id>/hold', methods=['POST'])
+@login_required
+def hold_slot(doctor_id):
+    """Reserve a slot for SLOT_HOLD_TTL seconds while the patient completes the booking."""
+    if current_user.role != 'patient':
+        return jsonify({'error': 'Only patients can hold slots'}), 403
+    doc = Doctor.query.get_or_404(doctor_id)
+    if not doc.user.active:
+        return jsonify({'error': 'Doctor is not available'}), 409
+    data = request.get_json(silent=True) or request.form
+    try:
+        slot_date = datetime.strptime(data.get('date') or '', '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'date must be YYYY-MM-DD'}), 400
+    if slot_date < date.today():
+        return jsonify({'error': 'date is in the past'}), 400
+    slot_time = data.get('time')
+    if not slot_time or not slot_offered(doctor_id, slot_date, slot_time):
+        return jsonify({'error': 'Selected time not available for this doctor'}), 400
+    if db.session.execute(db.select(Appointment.id).filter_by(
+            doctor_id=doctor_id, date=slot_date, time=slot_time)).first():
+        return jsonify({'error': 'slot already booked'}), 409
+    expires_at = acquire_hold(doctor_id, slot_date, slot_time, current_patient().id)
+    if not expires_at:
+        return jsonify({'error': 'slot is held by another patient'}), 409
+    return jsonify({'doctor_id': doctor_id, 'date': slot_date.isoformat(), 'time': slot_time,
+                    'expires_at': expires_at.isoformat() + 'Z'})
+
+
+@bp.route('/appointment/<int:appt_id>/cancel', methods=['POST'])
 @login_required
 def cancel_appointment(appt_id):
     appt = Appointment.query.get_or_404(appt_id)
     # allow patient or doctor or admin to cancel
     if current_user.role == 'patient' and appt.patient.user_id != current_user.id:
-        flash('Unauthorized', 'danger'); return redirect(url_for('home'))
+        flash('Unauthorized', 'danger'); return redirect(url_for('.home'))
     if current_user.role == 'doctor' and appt.doctor.user_id != current_user.id:
-        flash('Unauthorized', 'danger'); return redirect(url_for('home'))
+        flash('Unauthorized', 'danger'); return redirect(url_for('.home'))
     appt.status = 'Cancelled'
+    # tell whoever did not cancel it
+    if current_user.role == 'patient':
+        recipient, message = appt.doctor.user_id, f'{appt.patient.user.full_name} cancelled their appointment'
+    else:
+        recipient, message = appt.patient.user_id, f'{appt.doctor.user.full_name} cancelled your appointment'
+    db.session.execute(dialect_insert(Notification).values(
+        user_id=recipient, appointment_id=appt.id, kind='cancelled', created_at=datetime.utcnow(),
+        message=f'{message} on {appt.date.isoformat()} at {appt.time}')
+        .on_conflict_do_nothing(index_elements=['appointment_id', 'kind']))
     db.session.commit()
     flash('Appointment cancelled', 'success')
-    return redirect(request.referrer or url_for('home'))
+    return redirect(request.referrer or url_for('.home'))
 
 
-@app.route('/patient/history')
+@bp.route('/patient/history')
 @login_required
 def patient_history():
     if current_user.role != 'patient':
-        flash('Unauthorized', 'danger'); return redirect(url_for('home'))
-    patient = Patient.query.filter_by(user_id=current_user.id).first()
-    appointments = Appointment.query.filter_by(patient_id=patient.id).order_by(Appointment.date.desc()).all()
-    return render_template('appointment_history.html', appointments=appointments)
+        flash('Unauthorized', 'danger'); return redirect(url_for('.home'))
+    patient = current_patient()
+    include_archived = request.args.get('include_archived') in ('1', 'true')
+    # doctor names on the page come from the directory, so its version counts too
+    token, _ = version_state([('patient', patient.id), ('doctor_directory', 0)])
+    etag = make_etag('patient_history', current_user.id, token, include_archived)
+    return conditional_page(etag, lambda: render_template(
+        'appointment_history.html', appointments=patient_appointments(patient.id, include_archived),
+        include_archived=include_archived))
 
 
 # -------------------------
 # Search (Patients & Doctors for patients)
 # -------------------------
-@app.route('/search/doctors', methods=['GET'])
+@bp.route('/search/doctors', methods=['GET'])
 @login_required
 def search_doctors():
     q = request.args.get('q', '').strip()
     dept = request.args.get('dept', '').strip()
-    query = Doctor.query.join(User)
-    if q:
-        query = query.filter((User.full_name.ilike(f'%{q}%')) | (User.username.ilike(f'%{q}%')))
-    if dept:
-        query = query.filter(Doctor.specialization.ilike(f'%{dept}%') | Doctor.department.has(Department.name.ilike(f'%{dept}%')))
-    results = query.all()
-    return render_template('search_doctors.html', doctors=results, q=q, dept=dept)
-
-
-@app.route('/search/patients', methods=['GET'])
+    page = max(request.args.get('page', 1, type=int), 1)
+    if q or dept:
+        results, has_next = search_directory(
+            'doctor', [(q, ['full_name', 'username']), (dept, ['specialization', 'department'])], page)
+        doctor_cards = Markup(render_template('_doctor_cards.html', doctors=[directory_entry(d) for d in results]))
+        return render_template('search_doctors.html', doctor_cards=doctor_cards, q=q, dept=dept, page=page,
+                               has_next=has_next)
+    # the unfiltered listing is a page of the directory snapshot
+    directory = doctor_directory.get()
+    etag = f'{directory.etag}-u{current_user.id}-p{page}'
+    cached = not_modified(etag, page=True)
+    if cached:
+        return cached
+    size = current_app.config['SEARCH_PAGE_SIZE']
+    entries = directory.doctors[(page - 1) * size:page * size]
+    doctor_cards = directory.rendered(('cards', page), lambda: Markup(
+        render_template('_doctor_cards.html', doctors=entries)))
+    resp = current_app.make_response(render_template(
+        'search_doctors.html', doctor_cards=doctor_cards, q=q, dept=dept, page=page,
+        has_next=len(directory.doctors) > page * size))
+    return with_etag(resp, etag)
+
+
+@bp.route('/search/patients', methods=['GET'])
 @login_required
 def search_patients():
     if current_user.role != 'admin':
-        flash('Unauthorized', 'danger'); return redirect(url_for('home'))
+        flash('Unauthorized', 'danger'); return redirect(url_for('.home'))
     q = request.args.get('q','').strip()
-    query = Patient.query.join(User)
-    if q:
-        query = query.filter((User.full_name.ilike(f'%{q}%')) | (User.username.ilike(f'%{q}%')) | (Patient.id == q))
-    results = query.all()
-    return render_template('search_patients.html', patients=results, q=q)
+    page = request.args.get('page', 1, type=int)
+    results, has_next = search_directory('patient', [(q, ['full_name', 'username'])], page)
+    if q.isdigit() and page == 1:
+        by_id = Patient.query.options(joinedload(Patient.user)).get(int(q))
+        if by_id and by_id not in results:
+            results.insert(0, by_id)
+    return render_template('search_patients.html', patients=results, q=q, page=page, has_next=has_next)
+
+
+@bp.route('/api/search/typeahead', methods=['GET'])
+@login_required
+def api_typeahead():
+    """Top prefix matches for search boxes: ``?q=car&type=doctor|patient``."""
+    q = request.args.get('q', '').strip()
+    type_ = request.args.get('type', 'doctor')
+    if type_ not in ('doctor', 'patient'):
+        return jsonify({'error': 'type must be doctor or patient'}), 400
+    if type_ == 'patient' and current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    columns = ['full_name', 'username'] + (['specialization', 'department'] if type_ == 'doctor' else ['contact'])
+    match = search_match_expr(q, columns)
+    if not match:
+        return jsonify({'results': []})
+    limit = current_app.config['TYPEAHEAD_LIMIT']
+    if search_index_available():
+        rows = db.session.execute(db.text(
+            f'SELECT entity_id AS id, full_name, username, specialization, department FROM search_fts '
+            f'WHERE search_fts MATCH :match AND kind = :kind ORDER BY {SEARCH_RANK} LIMIT :limit'),
+            {'match': match, 'kind': type_, 'limit': limit}).all()
+    else:
+        stmt = doctor_rows_stmt() if type_ == 'doctor' else patient_rows_stmt()
+        like = or_(*[SEARCH_LIKE_COLUMNS[c].ilike(f'{q}%') for c in columns])
+        rows = db.session.execute(stmt.where(like).limit(limit)).all()
+    return jsonify({'results': [{'id': r.id, 'name': r.full_name, 'username': r.username,
+                                 'specialization': getattr(r, 'specialization', None),
+                                 'department': getattr(r, 'department', None)} for r in rows]})
 
 
 # -------------------------
 # Simple JSON APIs (optional usage)
 # -------------------------
-@app.route('/api/doctors', methods=['GET'])
+def api_page_args():
+    """Parse ``?after=<id>&limit=`` into (after, limit); raises ValueError on bad input."""
+    after = int(request.args.get('after', 0) or 0)
+    limit = int(request.args.get('limit', current_app.config['API_PAGE_SIZE']) or current_app.config['API_PAGE_SIZE'])
+    if after < 0 or limit < 1:
+        raise ValueError('after must be >= 0 and limit >= 1')
+    return after, min(limit, current_app.config['API_MAX_PAGE_SIZE'])
+
+
+def wants_ndjson():
+    return request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+
+
+def ndjson_response(stmt, row_fn):
+    """Stream every row of ``stmt`` as newline-delimited JSON.
+
+    The statement is executed once with ``yield_per`` so rows are fetched in
+    batches straight from the cursor and memory stays flat.
+    """
+    stmt = stmt.execution_options(yield_per=current_app.config['API_STREAM_BATCH'])
+
+    def generate():
+        for row in db.session.execute(stmt):
+            yield json.dumps(row_fn(row)) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def json_page(key, stmt, row_fn, id_column, after, limit):
+    """Run one keyset page of ``stmt`` (ordered by ``id_column``) and wrap it as JSON."""
+    rows = db.session.execute(stmt.where(id_column > after).limit(limit + 1)).all()
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = rows[-1].id
+    return jsonify({key: [row_fn(r) for r in rows], 'next_after': next_after})
+
+
+def doctor_rows_stmt():
+    return (db.select(Doctor.id, User.full_name, User.username, Doctor.specialization,
+                      Department.name.label('department'))
+            .join(User, User.id == Doctor.user_id)
+            .outerjoin(Department, Department.id == Doctor.department_id)
+            .order_by(Doctor.id))
+
+
+def doctor_row(r):
+    return {'id': r.id, 'name': r.full_name, 'username': r.username,
+            'specialization': r.specialization, 'department': r.department}
+
+
+def directory_row(e):
+    return {'id': e.id, 'name': e.name, 'username': e.username, 'specialization': e.specialization,
+            'department': e.department, 'active': e.active}
+
+
+def patient_rows_stmt():
+    return (db.select(Patient.id, User.full_name, User.username)
+            .join(User, User.id == Patient.user_id)
+            .order_by(Patient.id))
+
+
+def patient_row(r):
+    return {'id': r.id, 'name': r.full_name, 'username': r.username}
+
+
+def appointment_rows_stmt(args):
+    """Flat appointment projection with the filters from ``args`` applied.
+
+    Supported filters: ``date_from``, ``date_to`` (YYYY-MM-DD), ``doctor_id``,
+    ``patient_id`` and ``status``. Raises ValueError on malformed values.
+    """
+    doctor_user = aliased(User)
+    patient_user = aliased(User)
+    stmt = (db.select(Appointment.id, Appointment.doctor_id, Appointment.patient_id,
+                      doctor_user.full_name.label('doctor'), patient_user.full_name.label('patient'),
+                      Appointment.date, Appointment.time, Appointment.status)
+            .join(Doctor, Doctor.id == Appointment.doctor_id)
+            .join(doctor_user, doctor_user.id == Doctor.user_id)
+            .join(Patient, Patient.id == Appointment.patient_id)
+            .join(patient_user, patient_user.id == Patient.user_id)
+            .order_by(Appointment.id))
+    if args.get('date_from'):
+        stmt = stmt.where(Appointment.date >= datetime.strptime(args['date_from'], '%Y-%m-%d').date())
+    if args.get('date_to'):
+        stmt = stmt.where(Appointment.date <= datetime.strptime(args['date_to'], '%Y-%m-%d').date())
+    if args.get('doctor_id'):
+        stmt = stmt.where(Appointment.doctor_id == int(args['doctor_id']))
+    if args.get('patient_id'):
+        stmt = stmt.where(Appointment.patient_id == int(args['patient_id']))
+    if args.get('status'):
+        stmt = stmt.where(Appointment.status == args['status'])
+    return stmt
+
+
+def appointment_row(r):
+    return {'id': r.id, 'doctor_id': r.doctor_id, 'patient_id': r.patient_id, 'doctor': r.doctor,
+            'patient': r.patient, 'date': r.date.isoformat(), 'time': r.time, 'status': r.status}
+
+
+@bp.route('/api/doctors', methods=['GET'])
 def api_doctors():
-    docs = Doctor.query.all()
-    out = []
-    for d in docs:
-        out.append({
-            'id': d.id,
-            'name': d.user.full_name,
-            'username': d.user.username,
-            'specialization': d.specialization,
-            'department': d.department.name if d.department else None
-        })
-    return jsonify({'doctors': out})
-
-
-@app.route('/api/patients', methods=['GET'])
+    """The doctor directory, served from the in-memory snapshot with an ETag."""
+    try:
+        department_id = request.args.get('department_id', type=int)
+        after, limit = api_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    directory = doctor_directory.get()
+    ndjson = wants_ndjson()
+    etag = f'{directory.etag}-' + hashlib.sha1(
+        f'{department_id}:{after}:{limit}:{ndjson}'.encode('utf-8')).hexdigest()[:12]
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    entries = [e for e in directory.doctors if not department_id or e.department_id == department_id]
+    if ndjson:
+        return with_etag(Response(''.join(json.dumps(directory_row(e)) + '\n' for e in entries),
+                                  mimetype='application/x-ndjson'), etag)
+    page = [e for e in entries if e.id > after][:limit + 1]
+    next_after = page[limit - 1].id if len(page) > limit else None
+    return with_etag(jsonify({'doctors': [directory_row(e) for e in page[:limit]], 'next_after': next_after}), etag)
+
+
+@bp.route('/api/patients', methods=['GET'])
 def api_patients():
-    patients = Patient.query.all()
-    return jsonify({'patients': [{'id': p.id, 'name': p.user.full_name, 'username': p.user.username} for p in patients]})
+    stmt = patient_rows_stmt()
+    if wants_ndjson():
+        return ndjson_response(stmt, patient_row)
+    try:
+        after, limit = api_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return json_page('patients', stmt, patient_row, Patient.id, after, limit)
 
 
-@app.route('/api/appointments', methods=['GET', 'POST'])
+@bp.route('/api/doctor/schedule', methods=['GET'])
+@login_required
+def api_doctor_schedule():
+    """The logged-in doctor's appointments and per-day occupancy for a window."""
+    if current_user.role != 'doctor':
+        return jsonify({'error': 'Unauthorized'}), 403
+    doc = current_doctor()
+    try:
+        start, end, view = parse_schedule_window(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return conditional_json([('doctor', doc.id)], lambda: jsonify({
+        'start': start.isoformat(), 'end': end.isoformat(), 'view': view,
+        'days': occupancy_days(doc.id, start, end),
+        'appointments': [{'id': a.id, 'patient_id': a.patient_id, 'patient': a.patient.user.full_name,
+                          'date': a.date.isoformat(), 'time': a.time, 'status': a.status}
+                         for a in doctor_window(doc.id, start, end)],
+    }), current_user.id, start, end)
+
+
+@bp.route('/api/doctors/<int:doctor_id>/occupancy', methods=['GET'])
+def api_doctor_occupancy(doctor_id):
+    """Calendar overview from the occupancy counters, e.g. ``?view=range&start=...&end=...``."""
+    try:
+        start, end, _ = parse_schedule_window(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return conditional_json([('doctor', doctor_id)], lambda: jsonify(
+        {'doctor_id': doctor_id, 'days': occupancy_days(doctor_id, start, end)}), start, end)
+
+
+@bp.route('/api/appointments/bulk', methods=['POST'])
+@login_required
+def api_appointments_bulk():
+    """Bulk booking/import: JSON array or CSV (body or ``file`` upload); reports per-row outcome."""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+    upload = request.files.get('file')
+    if upload:
+        raw = upload.read().decode('utf-8-sig')
+        content_type = 'text/csv' if upload.filename.lower().endswith('.csv') else (upload.mimetype or '')
+    else:
+        raw = request.get_data(as_text=True)
+        content_type = request.mimetype or ''
+    try:
+        records = read_appointment_records(raw, content_type)
+    except (ValueError, csv.Error) as e:
+        return jsonify({'error': f'could not parse body: {e}'}), 400
+    results = bulk_import_appointments(records)
+    return jsonify({'summary': summarize_import(results), 'results': results})
+
+
+@bp.route('/api/slots/free', methods=['GET'])
+def api_free_slots():
+    """Free slots across doctors, e.g. ``?department=Cardiology&date_from=...&time=10:00``."""
+    try:
+        date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').date() \
+            if request.args.get('date_from') else date.today()
+        date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').date() \
+            if request.args.get('date_to') else date_from
+        stmt = free_slots_stmt(date_from, date_to,
+                               department=request.args.get('department'),
+                               department_id=int(request.args['department_id']) if request.args.get('department_id') else None,
+                               doctor_id=int(request.args['doctor_id']) if request.args.get('doctor_id') else None,
+                               time=request.args.get('time'))
+        _, limit = api_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    rows = db.session.execute(stmt.limit(limit)).all()
+    return jsonify({'slots': [{'doctor_id': r.doctor_id, 'doctor': r.doctor, 'specialization': r.specialization,
+                               'department': r.department, 'date': r.date.isoformat(), 'time': r.time}
+                              for r in rows]})
+
+
+@bp.route('/api/treatments/<int:treatment_id>', methods=['GET'])
+@login_required
+def api_treatment(treatment_id):
+    """Full text of one treatment; history pages only carry previews."""
+    t = find_treatment(treatment_id)
+    if t is None:
+        return jsonify({'error': 'Not found'}), 404
+    appt = t.appointment
+    if not (current_user.role == 'admin'
+            or (current_user.role == 'patient' and appt.patient.user_id == current_user.id)
+            or (current_user.role == 'doctor' and appt.doctor.user_id == current_user.id)):
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify({'id': t.id, 'appointment_id': t.appointment_id, 'diagnosis': t.diagnosis,
+                    'prescription': t.prescription, 'notes': t.notes,
+                    'created_at': t.created_at.isoformat() if t.created_at else None})
+
+
+@bp.route('/api/appointments', methods=['GET', 'POST'])
 def api_appointments():
     if request.method == 'GET':
-        appts = Appointment.query.all()
-        def ap(a):
-            return {'id': a.id, 'doctor': a.doctor.user.full_name, 'patient': a.patient.user.full_name, 'date': a.date.isoformat(), 'time': a.time, 'status': a.status}
-        return jsonify({'appointments': [ap(a) for a in appts]})
+        try:
+            stmt = appointment_rows_stmt(request.args)
+            if wants_ndjson():
+                return ndjson_response(stmt, appointment_row)
+            after, limit = api_page_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        page = lambda: json_page('appointments', stmt, appointment_row, Appointment.id, after, limit)
+        # one patient's or doctor's appointments can be revalidated cheaply; unfiltered listings cannot
+        keys = [(kind, int(request.args[f'{kind}_id'])) for kind in ('patient', 'doctor')
+                if request.args.get(f'{kind}_id')]
+        return conditional_json(keys, page) if keys else page()
     data = request.get_json()
     if not data:
         return jsonify({'error':'JSON body required'}), 400
     try:
         appt_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
         appt = Appointment(patient_id=int(data['patient_id']), doctor_id=int(data['doctor_id']), date=appt_date, time=data['time'])
+        holder = active_hold(appt.doctor_id, appt_date, appt.time)
+        if holder and holder.patient_id != appt.patient_id:
+            return jsonify({'error': 'slot is held by another patient'}), 409
         db.session.add(appt)
+        if holder:
+            release_hold(appt.doctor_id, appt_date, appt.time, appt.patient_id)
         db.session.commit()
         return jsonify({'status':'created', 'id': appt.id}), 201
     except Exception as e:
@@ -521,12 +3542,239 @@ def api_appointments():
         return jsonify({'error': str(e)}), 400
 
 
+# -------------------------
+# CLI
+# -------------------------
+@bp.cli.command('upgrade-schema')
+def upgrade_schema_command():
+    """Add missing tables/indexes and apply SQLite tuning to an existing database."""
+    for action in upgrade_schema():
+        print(action)
+
+
+@bp.cli.command('import-appointments')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_appointments_command(path):
+    """Bulk-load appointments from a .json or .csv file."""
+    with open(path, encoding='utf-8-sig') as fh:
+        records = read_appointment_records(fh.read(), 'text/csv' if path.lower().endswith('.csv') else '')
+    results = bulk_import_appointments(records)
+    for r in results:
+        if r['status'] != 'created':
+            print(f"row {r['row']}: {r['status']} - {r['error']}")
+    print(', '.join(f'{n} {status}' for status, n in summarize_import(results).items()))
+
+
+@bp.cli.command('rebuild-occupancy')
+def rebuild_occupancy_command():
+    """Recompute the per-doctor, per-day occupancy counters."""
+    db.create_all()
+    rebuild_occupancy()
+    print('occupancy counters rebuilt')
+
+
+@bp.cli.command('export-appointments')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='csv')
+@click.option('--out', type=click.Path(dir_okay=False), default='-', help='output file (default: stdout)')
+@click.option('--gzip', 'use_gzip', is_flag=True, help='gzip the output')
+@click.option('--date-from', default=None, help='YYYY-MM-DD')
+@click.option('--date-to', default=None, help='YYYY-MM-DD')
+@click.option('--department', default=None)
+@click.option('--watermark', default=None, help='name of an incremental export; only new rows are written')
+@click.option('--live-only', is_flag=True, help='skip archived appointments')
+def export_appointments_command(fmt, out, use_gzip, date_from, date_to, department, watermark, live_only):
+    """Stream appointments and their treatments (archived ones too) to a file."""
+    try:
+        filters = export_filters({'date_from': date_from, 'date_to': date_to, 'department': department,
+                                  'include_archived': not live_only})
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    mark = get_watermark(watermark) if watermark else None
+    rows = export_rows(export_stmt(watermark=mark, **filters), mark)
+    chunks = csv_chunks(rows) if fmt == 'csv' else ndjson_chunks(rows)
+    if use_gzip:
+        with click.open_file(out, 'wb') as fh:
+            for chunk in gzip_chunks(chunks):
+                fh.write(chunk)
+    else:
+        with click.open_file(out, 'w', encoding='utf-8', newline='') as fh:
+            for chunk in chunks:
+                fh.write(chunk)
+    if mark:
+        click.echo(f'{mark.rows} rows exported; watermark {mark.name} at appointment '
+                   f'{mark.last_appointment_id}, treatment {mark.last_treatment_id}', err=True)
+
+
+@bp.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Backfill the reporting rollups from the raw appointment/treatment tables."""
+    db.create_all()
+    rebuild_rollups()
+    print('reporting rollups rebuilt')
+
+
+@bp.cli.command('archive-appointments')
+@click.option('--horizon-days', type=int, default=None, help='archive finished appointments older than this')
+@click.option('--batch-size', type=int, default=None)
+@click.option('--vacuum', is_flag=True, help='VACUUM afterwards to return freed pages to the filesystem')
+@click.option('--dry-run', is_flag=True, help='only report what would be moved')
+def archive_appointments_command(horizon_days, batch_size, vacuum, dry_run):
+    """Move old completed/cancelled appointments and their treatments to the archive.
+
+    Meant to be run periodically (e.g. nightly from cron).
+    """
+    db.create_all()
+    horizon = current_app.config['ARCHIVE_HORIZON_DAYS'] if horizon_days is None else horizon_days
+    before = date.today() - timedelta(days=horizon)
+    size_before, _ = database_space()
+    moved = archive_appointments(before, batch_size, dry_run)
+    verb = 'would move' if dry_run else 'moved'
+    print(f"{verb} {moved['appointments']} appointments and {moved['treatments']} treatments dated before "
+          f"{before.isoformat()}" + ('' if dry_run else f" in {moved['batches']} batches"))
+    if dry_run or size_before is None:
+        return
+    if vacuum:
+        vacuum_database()
+    size_after, free = database_space()
+    print(f'database {size_before} -> {size_after} bytes ({size_before - size_after} reclaimed, '
+          f'{free} bytes free for reuse)')
+
+
+@bp.cli.command('compact-treatments')
+def compact_treatments_command():
+    """Refresh treatment previews and compress large treatment texts at rest."""
+    db.create_all()
+    for model in (Treatment, TreatmentArchive):
+        print(f'{compact_treatment_text(model)} {model.__tablename__} rows rewritten')
+
+
+@bp.cli.command('run-worker')
+@click.option('--threads', type=int, default=None, help='jobs run concurrently (default JOB_WORKER_THREADS)')
+@click.option('--once', is_flag=True, help='exit when no job is ready instead of polling')
+def run_worker_command(threads, once):
+    """Process background jobs."""
+    db.create_all()
+    processed = run_worker(current_app._get_current_object(), threads=threads, once=once)
+    print(f'{processed} jobs processed')
+
+
+@bp.cli.command('enqueue-job')
+@click.argument('kind', type=click.Choice(sorted(JOB_HANDLERS)))
+@click.option('--payload', default='{}', help='JSON payload, e.g. \'{"date": "2024-05-01"}\'')
+def enqueue_job_command(kind, payload):
+    """Queue a background job (e.g. nightly appointment_reminders from cron)."""
+    try:
+        payload = json.loads(payload)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    job = enqueue_job(kind, payload)
+    db.session.commit()
+    print(f'job {job.id} queued')
+
+
+@bp.cli.command('sweep-holds')
+def sweep_holds_command():
+    """Delete expired slot holds."""
+    db.create_all()
+    print(f'{sweep_expired_holds()} expired holds removed')
+
+
+@bp.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Create (if needed) and repopulate the full-text search index."""
+    db.create_all()
+    rebuild_search_index()
+    db.session.commit()
+    print('search index rebuilt')
+
+
+@bp.cli.command('migrate-availability')
+def migrate_availability_command():
+    """Move legacy availability_json blobs into the slot table."""
+    db.create_all()
+    print(f'{migrate_availability_json()} slots migrated')
+
+
+@bp.cli.command('materialize-availability')
+@click.option('--days', type=int, default=None, help='horizon in days (default AVAILABILITY_HORIZON_DAYS)')
+@click.option('--doctor', 'doctor_ids', type=int, multiple=True, help='only these doctors (repeatable)')
+def materialize_availability_command(days, doctor_ids):
+    """Expand availability rules into the slot table.
+
+    A running ``flask run-worker`` rolls the horizon forward daily by itself;
+    without a worker, run this from cron once a day, or /api/slots/free and the
+    occupancy slot counts run dry after AVAILABILITY_HORIZON_DAYS.
+    """
+    db.create_all()
+    converted = migrate_slots_to_rules()
+    inserted, deleted = materialize_availability(list(doctor_ids) or None, days=days)
+    print(f'{converted} legacy slots converted to exceptions; {inserted} slots added, {deleted} removed')
+
+
+@bp.cli.command('bootstrap')
+def bootstrap_command():
+    """Create or upgrade the schema and seed default data; safe to re-run."""
+    for action in bootstrap():
+        print(action)
+
+
+# -------------------------
+# Application factory
+# -------------------------
+def bootstrap():
+    """Everything a fresh or older database needs before serving; idempotent.
+
+    Run it once per deployment (``flask --app app bootstrap``), not from every worker.
+    """
+    actions = upgrade_schema()
+    create_default_data()  # ensures predefined admin exists
+    migrated = migrate_availability_json()
+    if migrated:
+        actions.append(f'{migrated} legacy availability slots migrated')
+    kept = migrate_slots_to_rules()
+    if kept:
+        actions.append(f'{kept} upcoming slots kept as availability exceptions')
+    inserted, deleted = materialize_availability()
+    if inserted or deleted:
+        actions.append(f'availability materialized: {inserted} slots added, {deleted} removed')
+    return actions
+
+
+def create_app(config=None):
+    """Build an application: DEFAULT_CONFIG, then the environment, then ``config``.
+
+    HMS_-prefixed environment variables override individual keys (values are
+    parsed as JSON where possible, e.g. HMS_DB_POOL_SIZE=5).
+    """
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config_from_env())
+    app.config.from_prefixed_env('HMS')
+    app.config.update(config or {})
+    if app.config['PASSWORD_VERIFY_MAX_PENDING'] is None:
+        app.config['PASSWORD_VERIFY_MAX_PENDING'] = 4 * app.config['PASSWORD_VERIFY_WORKERS']
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
+    db.init_app(app)
+    init_engines(app)
+    login_manager.init_app(app)
+    profile_cache.maxsize, profile_cache.ttl = app.config['PROFILE_CACHE_SIZE'], app.config['PROFILE_CACHE_TTL']
+    page_cache.maxsize, page_cache.ttl = app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL']
+    schedule_cache.maxsize, schedule_cache.ttl = app.config['SCHEDULE_CACHE_SIZE'], app.config['SCHEDULE_CACHE_TTL']
+    login_user_limiter.burst = app.config['LOGIN_USER_BURST']
+    login_user_limiter.refill_per_sec = app.config['LOGIN_USER_REFILL_PER_SEC']
+    login_ip_limiter.burst = app.config['LOGIN_IP_BURST']
+    login_ip_limiter.refill_per_sec = app.config['LOGIN_IP_REFILL_PER_SEC']
+    profiler.init_app(app)
+    app.register_blueprint(bp)
+    return app
+
+
 # -------------------------
 # Run
 # -------------------------
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
-        db.create_all()
-        create_default_data()  # ensures predefined admin exists
+        bootstrap()
     app.run(debug=True)
-
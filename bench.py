@@ -0,0 +1,345 @@
+# bench.py
+"""Load-testing harness for the booking and dashboard hot paths.
+
+Seeds a synthetic hospital into a throwaway SQLite database, drives the app
+through the Flask test client and reports latency percentiles, throughput,
+SQL queries per request and peak memory. Results are written as JSON so runs
+can be compared between versions:
+
+    python bench.py --doctors 50 --patients 5000 --appointments 200000
+    python bench.py --concurrency 8 --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+SLOT_TIMES = [f'{h:02d}:{m:02d}' for h in range(8, 18) for m in (0, 30)]
+PASSWORD = 'bench-pass'
+ADMIN_PASSWORD = 'admin123'  # set by create_default_data()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--doctors', type=int, default=20)
+    parser.add_argument('--patients', type=int, default=500)
+    parser.add_argument('--appointments', type=int, default=10000)
+    parser.add_argument('--treatments', type=int, default=None,
+                        help='treatments to seed (default: one per completed appointment)')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='client threads per scenario')
+    parser.add_argument('--scenarios', default='all', help='comma separated scenario names')
+    parser.add_argument('--db', default=None, help='SQLite file to use (default: temporary file)')
+    parser.add_argument('--force', action='store_true',
+                        help='allow --db to name an existing file; seeding drops all of its tables')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure Python peak allocations with tracemalloc (slows requests)')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', default=None, help='previous results file to diff against')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent p95/query-count increase reported as a regression')
+    return parser.parse_args(argv)
+
+
+# -------------------------
+# Seeding
+# -------------------------
+def seed(hms, args):
+    """Bulk-insert a synthetic hospital using the app's models."""
+    db = hms.db
+    pw_hash = hms.generate_password_hash(PASSWORD)
+    db.drop_all()
+    db.create_all()
+    hms.create_default_data()
+    dept_ids = db.session.execute(db.select(hms.Department.id)).scalars().all()
+
+    def insert(model, rows, batch=5000):
+        for i in range(0, len(rows), batch):
+            db.session.execute(db.insert(model), rows[i:i + batch])
+        db.session.commit()
+
+    first_user = (db.session.execute(db.select(db.func.max(hms.User.id))).scalar() or 0) + 1
+    users = [{'id': first_user + i, 'username': f'doctor{i}', 'role': 'doctor', 'full_name': f'Doctor {i} Bench',
+              'contact': f'100{i:06d}', 'password_hash': pw_hash, 'active': True} for i in range(args.doctors)]
+    users += [{'id': first_user + args.doctors + i, 'username': f'patient{i}', 'role': 'patient',
+               'full_name': f'Patient {i} Bench', 'contact': f'200{i:06d}', 'password_hash': pw_hash, 'active': True}
+              for i in range(args.patients)]
+    insert(hms.User, users)
+    insert(hms.Doctor, [{'id': i + 1, 'user_id': first_user + i, 'specialization': f'Spec{i % 7}',
+                         'department_id': dept_ids[i % len(dept_ids)]} for i in range(args.doctors)])
+    insert(hms.Patient, [{'id': i + 1, 'user_id': first_user + args.doctors + i, 'age': 20 + i % 60}
+                         for i in range(args.patients)])
+
+    # appointments fill a (doctor, day, slot) grid backwards and forwards from today
+    today = date.today()
+    per_day = args.doctors * len(SLOT_TIMES)
+    appts, statuses = [], ('Completed', 'Completed', 'Cancelled', 'Booked')
+    for k in range(args.appointments):
+        day = k // per_day
+        offset = -day if day % 4 else day // 4  # mostly history, some upcoming
+        appt_date = today + timedelta(days=offset)
+        appts.append({'id': k + 1, 'doctor_id': k % args.doctors + 1, 'patient_id': k % args.patients + 1,
+                      'date': appt_date, 'time': SLOT_TIMES[(k // args.doctors) % len(SLOT_TIMES)],
+                      'status': 'Booked' if appt_date >= today else statuses[k % len(statuses)]})
+    insert(hms.Appointment, appts)
+
+    completed = [a['id'] for a in appts if a['status'] == 'Completed']
+    n_treat = len(completed) if args.treatments is None else args.treatments
+    # Core inserts skip Treatment's @validates hook, so fill the previews the way it would
+    insert(hms.Treatment, [{'appointment_id': completed[i % len(completed)], 'diagnosis': f'Diagnosis {i}',
+                            'prescription': f'Prescription {i}', 'notes': 'Routine follow-up. ' * 5,
+                            'diagnosis_preview': hms.text_preview(f'Diagnosis {i}'),
+                            'prescription_preview': hms.text_preview(f'Prescription {i}'),
+                            'created_at': datetime.utcnow()} for i in range(n_treat if completed else 0)])
+
+    # weekly hours for every doctor so booking validation has work to do
+    insert(hms.AvailabilityRule, [{'doctor_id': d + 1, 'weekday': w, 'start_time': SLOT_TIMES[0], 'end_time': '18:00',
+                                   'slot_minutes': 30} for d in range(args.doctors) for w in range(7)])
+    hms.materialize_availability()
+    # bulk inserts bypass the write-time counters; derive them once
+    hms.rebuild_occupancy()
+    hms.rebuild_rollups()
+
+
+# -------------------------
+# Scenarios
+# -------------------------
+def login(client, username):
+    password = ADMIN_PASSWORD if username == 'admin' else PASSWORD
+    resp = client.post('/login', data={'username': username, 'password': password})
+    if resp.status_code != 302:
+        raise RuntimeError(f'login failed for {username}: {resp.status_code}')
+    return client
+
+
+class BookingSlots:
+    """Hands out distinct far-future (doctor, date, time) slots so bookings don't collide."""
+
+    def __init__(self, doctors):
+        self.doctors = doctors
+        self.base = date.today() + timedelta(days=400)
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            k = self.counter
+            self.counter += 1
+        day, rest = divmod(k, self.doctors * len(SLOT_TIMES))
+        return rest % self.doctors + 1, self.base + timedelta(days=day), SLOT_TIMES[rest // self.doctors]
+
+
+def build_scenarios(app, args):
+    slots = BookingSlots(args.doctors)
+
+    def fresh_login(client, i):
+        # a new client per attempt so every request really verifies a password
+        return app.test_client().post('/login', data={'username': f'patient{i % args.patients}',
+                                                      'password': PASSWORD})
+
+    def book(client, i):
+        doctor_id, d, t = slots.next()
+        return client.post(f'/doctor/{doctor_id}', data={'date': d.isoformat(), 'time': t})
+
+    def redirects_home(resp):
+        # both login and booking redirect on failure too, but back to their own form
+        return resp.status_code == 302 and '/login' not in resp.location and '/doctor/' not in resp.location
+
+    def ok(resp):
+        return resp.status_code == 200
+
+    # name -> (role to log in as, request function, success check)
+    return {
+        'login': (None, fresh_login, redirects_home),
+        'book': ('patient', book, redirects_home),
+        'patient_dashboard': ('patient', lambda c, i: c.get('/patient'), ok),
+        'doctor_dashboard': ('doctor', lambda c, i: c.get('/doctor'), ok),
+        'admin_dashboard': ('admin', lambda c, i: c.get('/admin'), ok),
+        'admin_search': ('admin', lambda c, i: c.get(f'/admin/search?type=patient&q=patient {i % 100}'), ok),
+        'api_appointments': (None, lambda c, i: c.get('/api/appointments?limit=100'), ok),
+        'api_patients': (None, lambda c, i: c.get('/api/patients?limit=100'), ok),
+        'api_doctors': (None, lambda c, i: c.get('/api/doctors'), ok),
+        'api_slots_free': (None, lambda c, i: c.get('/api/slots/free?limit=100'), ok),
+        'admin_reports': ('admin', lambda c, i: c.get('/admin/reports'), ok),
+    }
+
+
+# -------------------------
+# Measurement
+# -------------------------
+class QueryCounter:
+    """Counts SQL statements executed on the current thread."""
+
+    def __init__(self, engine, event):
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self.local, 'count', 0)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[k]
+
+
+def run_scenario(app, name, spec, args, counter):
+    role, fn, succeeded = spec
+    usernames = {'admin': ['admin'], 'doctor': ['doctor0'],
+                 'patient': [f'patient{i}' for i in range(min(args.patients, args.concurrency))]}
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+
+    def worker(worker_id, indexes):
+        client = app.test_client()
+        if role:
+            names = usernames[role]
+            login(client, names[worker_id % len(names)])
+        for i in indexes:
+            counter.reset()
+            start = time.perf_counter()
+            resp = fn(client, i)
+            resp.get_data()  # drain streamed bodies inside the timing window
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed * 1000)
+                queries.append(counter.count)
+                if not succeeded(resp):
+                    errors.append(resp.status_code)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(worker, w, range(w, args.requests, args.concurrency))
+                   for w in range(args.concurrency)]
+        for f in futures:
+            f.result()
+    wall = time.perf_counter() - started
+    peak_traced = None
+    if args.trace_memory:
+        peak_traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'error_statuses': sorted(set(errors)),
+        'throughput_rps': round(len(latencies) / wall, 2) if wall else None,
+        'latency_ms': {
+            'mean': round(statistics.fmean(latencies), 3) if latencies else None,
+            'p50': round(percentile(latencies, 50), 3) if latencies else None,
+            'p95': round(percentile(latencies, 95), 3) if latencies else None,
+            'p99': round(percentile(latencies, 99), 3) if latencies else None,
+            'max': round(latencies[-1], 3) if latencies else None,
+        },
+        'queries_per_request': {
+            'mean': round(statistics.fmean(queries), 2) if queries else None,
+            'max': max(queries) if queries else None,
+        },
+        'peak_traced_bytes': peak_traced,
+    }
+
+
+def peak_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """Print scenarios whose p95 latency or query count grew by more than ``threshold`` percent."""
+    with open(baseline_path) as fh:
+        baseline = json.load(fh)['scenarios']
+    regressions = []
+    for name, cur in results['scenarios'].items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        for label, new_v, old_v in (('p95 ms', cur['latency_ms']['p95'], old['latency_ms']['p95']),
+                                    ('queries', cur['queries_per_request']['mean'],
+                                     old['queries_per_request']['mean'])):
+            if old_v and new_v is not None and (new_v - old_v) / old_v * 100 > threshold:
+                regressions.append(f'{name}: {label} {old_v} -> {new_v}')
+    for line in regressions:
+        print('REGRESSION', line)
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.db and os.path.exists(args.db) and not args.force:
+        raise SystemExit(f'{args.db} exists and seeding would wipe it; pass --force to use it anyway')
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='hms-bench-'), 'bench.db')
+
+    import app as hms
+    from sqlalchemy import event
+
+    app = hms.create_app({
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{os.path.abspath(db_path)}',
+        # every simulated user logs in from one address; keep login throttling out of the numbers
+        'LOGIN_USER_BURST': 10 ** 9, 'LOGIN_IP_BURST': 10 ** 9,
+    })
+    with app.app_context():
+        t0 = time.perf_counter()
+        seed(hms, args)
+        seed_seconds = time.perf_counter() - t0
+        counter = QueryCounter(hms.db.engine, event)
+
+    scenarios = build_scenarios(app, args)
+    selected = list(scenarios) if args.scenarios == 'all' else args.scenarios.split(',')
+    results = {
+        'meta': {'timestamp': datetime.utcnow().isoformat() + 'Z', 'git_revision': git_revision(),
+                 'python': platform.python_version(), 'database': db_path, 'seed_seconds': round(seed_seconds, 2),
+                 'doctors': args.doctors, 'patients': args.patients, 'appointments': args.appointments,
+                 'requests': args.requests, 'concurrency': args.concurrency},
+        'scenarios': {},
+    }
+    print(f'{"scenario":<20}{"req":>6}{"err":>5}{"rps":>9}{"p50":>9}{"p95":>9}{"p99":>9}{"q/req":>8}')
+    for name in selected:
+        if name not in scenarios:
+            raise SystemExit(f'unknown scenario {name!r}; choose from {", ".join(scenarios)}')
+        res = run_scenario(app, name, scenarios[name], args, counter)
+        results['scenarios'][name] = res
+        lat = res['latency_ms']
+        print(f'{name:<20}{res["requests"]:>6}{res["errors"]:>5}{res["throughput_rps"]:>9}'
+              f'{lat["p50"]:>9}{lat["p95"]:>9}{lat["p99"]:>9}{res["queries_per_request"]["mean"]:>8}')
+    results['meta']['peak_rss_bytes'] = peak_rss_bytes()
+
+    with open(args.output, 'w') as fh:
+        json.dump(results, fh, indent=2)
+    print(f'results written to {args.output}')
+    if args.compare and compare(results, args.compare, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
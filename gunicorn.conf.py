@@ -0,0 +1,24 @@
+# gunicorn.conf.py -- multi-process production profile
+# Usage: flask --app app bootstrap && gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+
+bind = os.environ.get('HMS_BIND', '0.0.0.0:8000')
+# one process per core; each runs a few threads for I/O-bound requests
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('HMS_THREADS', 4))
+# the app is imported once in the master and forked; create_app re-pools the
+# database engines in every child, so no connection is shared across processes
+preload_app = True
+timeout = 30
+graceful_timeout = 30
+max_requests = 10000
+max_requests_jitter = 1000
+accesslog = '-'
+
+# Per-process resources scale with the worker count: size them so the whole
+# server stays within the core count and the database's connection limit.
+os.environ.setdefault('HMS_PASSWORD_VERIFY_WORKERS', '2')
+os.environ.setdefault('HMS_DB_POOL_SIZE', str(threads))
+os.environ.setdefault('HMS_DB_MAX_OVERFLOW', '2')
@@ -0,0 +1,13 @@
+# wsgi.py
+"""Production entry point: ``gunicorn -c gunicorn.conf.py wsgi:app``.
+
+Run ``flask --app app bootstrap`` once per deployment before starting workers.
+"""
+import os
+
+from app import create_app
+
+if not os.environ.get('SECRET_KEY'):
+    raise RuntimeError('SECRET_KEY must be set in the environment')
+
+app = create_app()